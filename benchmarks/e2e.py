@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+'''End-to-end benchmark against local fake Jira and SMTP
+
+Usage: benchmarks/e2e.py [--scale {10,1k,50k}]... [--mode {create,update,dry-run}]...
+           [--latency S] [--error-rate R] [--smtp-latency S] [--smtp-error-rate R]
+           [-- workflow-templater arguments, e.g. --concurrency 8 --bulk-create 50]
+
+Generates synthetic template dir for each scale: one release issue, a foreach
+of N host issues linked to the release and to the previous host, and a
+notification email per team. Then runs workflow-templater on it (in a separate
+process, with empty cache and config dirs) in each mode against fake services
+of fake_services.py:
+
+  create   create all issues and send emails
+  update   update issues created by create (--update), resend emails
+  dry-run  only render
+
+and prints wall time, issues per second, peak RSS of workflow-templater and
+requests handled by the fake services. 10 and 1k scales are run by default,
+50k takes minutes.
+'''
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_services import FakeJira, FakeSMTP  # noqa: E402
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+SCRIPT = os.path.join(ROOT, 'workflow_templater', '__init__.py')
+
+SCALES = {'10': 10, '1k': 1000, '50k': 50000}
+MODES = ('create', 'update', 'dry-run')
+TEAMS = 10
+
+TEMPLATES = {
+    '1_release.jira.yaml': '''\
+summary: Release {{ release }} to {{ hosts|length }} hosts
+project:
+  key: PRJ
+issuetype:
+  name: Task
+labels:
+- 'release_{{ release }}'
+description: |-
+  Rollout of {{ release }}, see linked issues.
+watchers:
+- '{{ release_manager }}'
+''',
+    '2_host.jira.yaml': '''\
+foreach_fromvar: hosts
+foreach_namevar: name
+summary: Deploy {{ release }} to {{ item.name }}
+project:
+  key: PRJ
+issuetype:
+  name: Sub-task
+parent:
+  key: '{{ issuekey_1_release }}'
+labels:
+- 'release_{{ release }}'
+- '{{ item.team }}'
+assignee:
+  name: '{{ item.team }}_oncall'
+update:
+  issuelinks:
+  - add:
+      type:
+        name: Blocks
+      inwardIssue:
+        key: '{{ issuekey_2_host[item.after] if item.after else issuekey_1_release }}'
+description: |-
+  {% if updating is defined %}Updated: {{ updating }}
+  {% endif %}Host: {{ item.name }} ({{ item.team }})
+  {% for step in steps %}# {{ step }} on {{ item.name }}
+  {% endfor %}
+watchers:
+- '{{ item.team }}_lead'
+''',
+    '3_notify.email.yaml': '''\
+foreach_fromvar: teams
+Subject: "{% if updating is defined %}Re: {% endif %}Release {{ release }} for {{ item }}"
+To:
+- '{{ item }}@example.com'
+Message-ID: "release-{{ issuekey_1_release }}-{{ item }}{% if updating is defined %}-{{ updating }}{% endif %}@example.com"
+Body: |-
+  Release {{ release }}: {{ issuekey_1_release }}
+  Hosts of {{ item }}: {{ hosts|selectattr('team', 'equalto', item)|list|length }}
+''',
+}
+
+
+def make_template_dir(path, count):
+    '''Returns number of issues and emails in it'''
+    os.makedirs(path)
+    teams = [f'team{i}' for i in range(TEAMS)]
+    common = {
+        'release': '1.0',
+        'release_manager': 'manager',
+        'steps': ['drain', 'upgrade', 'check', 'undrain'],
+        'teams': teams,
+        'hosts': [
+            {
+                'name': f'h{i}',
+                'team': teams[i % TEAMS],
+                'after': f'h{i - 1}' if i else None,
+            }
+            for i in range(count)
+        ],
+    }
+    with open(os.path.join(path, '0_common.yaml'), 'w', encoding='utf8') as f:
+        # JSON is YAML too, and much faster to dump
+        json.dump(common, f)
+    for filename, content in TEMPLATES.items():
+        with open(os.path.join(path, filename), 'w', encoding='utf8') as f:
+            f.write(content)
+    return 1 + count + TEAMS
+
+
+def run(args, env):
+    '''Returns (wall time, peak RSS in MiB, stdout) of workflow-templater with args'''
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, SCRIPT, *args],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    stdout = process.stdout.read()
+    # wait4 gives resource usage of this process only, unlike RUSAGE_CHILDREN
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(
+            f'workflow-templater {shlex.join(args)} failed with exit code {process.returncode}'
+        )
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    maxrss = rusage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return wall, maxrss, stdout
+
+
+def created_ids(stdout):
+    '''{issue name: id} from the update command printed by workflow-templater'''
+    cmd = [line for line in stdout.splitlines() if '--update' in line][-1]
+    cmd_parts = shlex.split(cmd)
+    return json.loads(cmd_parts[cmd_parts.index('--update') + 1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        usage=__doc__.split('\n\n')[1][len('Usage: ') :],
+    )
+    parser.add_argument('--scale', action='append', choices=SCALES)
+    parser.add_argument('--mode', action='append', choices=MODES)
+    parser.add_argument('--latency', type=float, default=0.0, metavar='S')
+    parser.add_argument('--error-rate', type=float, default=0.0, metavar='R')
+    parser.add_argument('--smtp-latency', type=float, default=0.0, metavar='S')
+    parser.add_argument('--smtp-error-rate', type=float, default=0.0, metavar='R')
+    parser.add_argument('workflow_args', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    scales = args.scale or ['10', '1k']
+    modes = args.mode or list(MODES)
+    if 'update' in modes and 'create' not in modes:
+        parser.error('update mode updates issues created by create mode')
+
+    print(
+        f'{"scale":>6} {"mode":>8} {"issues":>7} {"wall, s":>9} {"issues/s":>9} '
+        f'{"peak RSS, MiB":>14}  requests'
+    )
+    with (
+        FakeJira(latency=args.latency, error_rate=args.error_rate) as jira,
+        FakeSMTP(latency=args.smtp_latency, error_rate=args.smtp_error_rate) as smtp,
+        tempfile.TemporaryDirectory() as tmp,
+    ):
+        # don't touch user's caches and config
+        env = dict(os.environ, XDG_CACHE_HOME=tmp, XDG_CONFIG_HOME=tmp)
+        common_args = [
+            '--jira',
+            jira.url,
+            '--access-token',
+            'benchmark',
+            '--email-smtp',
+            smtp.address,
+            '--email-from',
+            'benchmark@example.com',
+            '--no-email-starttls',
+            *args.workflow_args,
+        ]
+        for scale in scales:
+            template_dir = os.path.join(tmp, f'templates_{scale}')
+            issues = make_template_dir(template_dir, SCALES[scale])
+            ids = None
+            for mode in MODES:
+                if mode not in modes:
+                    continue
+                mode_args = [*common_args, template_dir]
+                if mode == 'dry-run':
+                    mode_args.insert(0, '--dry-run')
+                elif mode == 'update':
+                    # too long for command line at 50k, config file options
+                    # are defaults of command line arguments
+                    config = os.path.join(tmp, f'update_{scale}.yaml')
+                    with open(config, 'w', encoding='utf8') as f:
+                        json.dump({'update': json.dumps(ids)}, f)
+                    mode_args[:0] = ['--config', config]
+                jira.counts.clear()
+                smtp.counts.clear()
+                wall, maxrss, stdout = run(mode_args, env)
+                if mode == 'create':
+                    ids = created_ids(stdout)
+                requests = ', '.join(
+                    f'{kind} {count}'
+                    for kind, count in sorted({**jira.counts, **smtp.counts}.items())
+                )
+                print(
+                    f'{scale:>6} {mode:>8} {issues:>7} {wall:>9.2f} {issues / wall:>9.1f} '
+                    f'{maxrss:>14.1f}  {requests or "-"}'
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+'''Local stand-ins for Jira REST API and SMTP server
+
+Usage: benchmarks/fake_services.py [--jira-port PORT] [--smtp-port PORT]
+           [--latency S] [--error-rate R] [--smtp-latency S] [--smtp-error-rate R]
+
+Serves until interrupted, so workflow-templater can be tried without live
+services:
+
+    workflow-templater --jira http://127.0.0.1:8765/ --access-token x \\
+        --email-smtp 127.0.0.1:8025 --email-from me@example.com --no-email-starttls DIR
+
+or used from other benchmarks:
+
+    with FakeJira(latency=0.05) as jira, FakeSMTP() as smtp:
+        ... jira.url, smtp.address, jira.counts ...
+
+FakeJira implements what workflow-templater uses: rest/api/2/issue (create),
+rest/api/2/issue/bulk, rest/api/2/issue/{key} (get, update),
+rest/api/2/issue/{key}/watchers and rest/auth/1/session (login with any
+password, sets a cookie). Any user and access token are accepted. With
+error_rate, that share of requests gets 429 with Retry-After: 0, which
+workflow-templater retries (and slows down).
+
+FakeSMTP accepts any message without STARTTLS and authentication (see
+--no-email-starttls). With error_rate, it drops the connection after that
+share of messages, which workflow-templater reconnects after.
+'''
+
+import argparse
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ISSUE_PATH = re.compile(
+    r'/rest/api/2/issue/(?P<key>[A-Z]+-\d+)(?P<watchers>/watchers)?$'
+)
+
+
+class FakeJiraHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, with Nagle's algorithm the body
+    # of each response waits for delayed ACK of the client (~40 ms) on keep-alive
+    # connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, obj=None, headers=()):
+        body = b'' if obj is None else json.dumps(obj).encode()
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if body:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        data = json.loads(self.rfile.read(length)) if length else None
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.error_rate and random.random() < fake.error_rate:
+            fake.count('throttled')
+            return self.send_json(429, {}, [('Retry-After', '0')])
+
+        path = self.path.split('?', 1)[0]
+        match = ISSUE_PATH.search(path)
+        if path.endswith('/rest/auth/1/session'):
+            fake.count('session')
+            return self.send_json(
+                200,
+                {'session': {'name': 'JSESSIONID', 'value': 'fake'}},
+                [('Set-Cookie', 'JSESSIONID=fake; Path=/')],
+            )
+        if path.endswith('/rest/api/2/issue/') and self.command == 'POST':
+            fake.count('create')
+            return self.send_json(201, fake.create(data['fields']))
+        if path.endswith('/rest/api/2/issue/bulk') and self.command == 'POST':
+            fake.count('bulk create')
+            issues = [fake.create(update['fields']) for update in data['issueUpdates']]
+            return self.send_json(201, {'issues': issues, 'errors': []})
+        if match is None:
+            fake.count('unknown')
+            return self.send_json(404, {'errorMessages': [f'unknown path {path}']})
+        key = match['key']
+        if key not in fake.issues:
+            fake.count('unknown')
+            return self.send_json(404, {'errorMessages': ['Issue Does Not Exist']})
+        if match['watchers']:
+            fake.count('watchers')
+            fake.issues[key].setdefault('watchers', []).append(data)
+            return self.send_json(204)
+        if self.command == 'PUT':
+            fake.count('update')
+            fake.issues[key].update(data.get('fields', {}))
+            return self.send_json(204)
+        fake.count('get')
+        return self.send_json(200, {'key': key, 'fields': fake.issues[key]})
+
+    do_GET = do_POST = do_PUT = handle_request
+
+
+class FakeService:
+    '''Runs server in a background thread, counts handled requests by kind'''
+
+    def __init__(self, server, latency, error_rate):
+        self.server = server
+        server.fake = self
+        self.latency = latency
+        self.error_rate = error_rate
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=server.serve_forever, daemon=True)
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] += 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class FakeJira(FakeService):
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, project='PRJ'):
+        super().__init__(
+            ThreadingHTTPServer(('127.0.0.1', port), FakeJiraHandler),
+            latency,
+            error_rate,
+        )
+        self.server.daemon_threads = True
+        self.project = project
+        self.issues = {}
+        self.last_id = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+
+    def create(self, fields):
+        with self.lock:
+            self.last_id += 1
+            id = self.last_id
+        key = f'{self.project}-{id}'
+        self.issues[key] = fields
+        return {
+            'id': str(id),
+            'key': key,
+            'self': f'{self.url}rest/api/2/issue/{id}',
+        }
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    # replies are written line by line
+    disable_nagle_algorithm = True
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        fake = self.server.fake
+        self.reply('220 fake SMTP')
+        in_data = False
+        for raw in self.rfile:
+            line = raw.decode('utf8', 'replace').rstrip('\r\n')
+            if in_data:
+                if line == '.':
+                    in_data = False
+                    if fake.latency:
+                        time.sleep(fake.latency)
+                    fake.count('message')
+                    self.reply('250 queued')
+                    if fake.error_rate and random.random() < fake.error_rate:
+                        fake.count('dropped')
+                        return
+                continue
+            command = line[:4].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250-fake SMTP')
+                self.reply('250-AUTH PLAIN LOGIN')
+                self.reply('250 8BITMIME')
+            elif command == 'AUTH':
+                fake.count('login')
+                self.reply('235 authenticated')
+            elif command == 'DATA':
+                in_data = True
+                self.reply('354 go ahead')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class ThreadingSMTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class FakeSMTP(FakeService):
+    def __init__(self, port=0, latency=0.0, error_rate=0.0):
+        super().__init__(
+            ThreadingSMTPServer(('127.0.0.1', port), FakeSMTPHandler),
+            latency,
+            error_rate,
+        )
+
+    @property
+    def address(self):
+        return '127.0.0.1:{}'.format(self.server.server_address[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--jira-port', type=int, default=8765)
+    parser.add_argument('--smtp-port', type=int, default=8025)
+    parser.add_argument('--latency', type=float, default=0.0, metavar='S')
+    parser.add_argument('--error-rate', type=float, default=0.0, metavar='R')
+    parser.add_argument('--smtp-latency', type=float, default=0.0, metavar='S')
+    parser.add_argument('--smtp-error-rate', type=float, default=0.0, metavar='R')
+    args = parser.parse_args()
+    with (
+        FakeJira(args.jira_port, args.latency, args.error_rate) as jira,
+        FakeSMTP(args.smtp_port, args.smtp_latency, args.smtp_error_rate) as smtp,
+    ):
+        print(f'jira: {jira.url}\nsmtp: {smtp.address}')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        print(dict(jira.counts), dict(smtp.counts))
+
+
+if __name__ == '__main__':
+    main()
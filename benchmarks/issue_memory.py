@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+'''Memory footprint of Issue objects created from one big foreach template
+
+Usage: benchmarks/issue_memory.py [number_of_issues]
+
+Works with revisions before Issue got __slots__ as well, so footprint
+can be compared by running it on both:
+
+    git stash; git checkout <old revision>; python benchmarks/issue_memory.py
+'''
+
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import workflow_templater as wt  # noqa: E402
+
+
+def make_data():
+    return {
+        'summary': '{{ item.name }} release',
+        'description': 'Deploy {{ item.name }} for {{ release }}',
+        'project': {'key': 'PRJ'},
+        'issuetype': {'name': 'Task'},
+        'watchers': ['{{ item.owner }}'],
+    }
+
+
+def create_issues(count, common_vars):
+    items = common_vars['hosts']
+    issues = []
+    if hasattr(wt.JiraIssue, 'Template'):
+        engine = wt.WorkflowEngine(jinja_cache_dir=None)
+        template = wt.JiraIssue.Template(
+            make_data(),
+            '1_host.jira.yaml',
+            '1_host',
+            common_vars,
+            False,
+            engine.backend_configs[wt.JiraIssue],
+            engine.workflow('.'),
+        )
+        for item in items:
+            issues.append(
+                wt.JiraIssue(
+                    name=f'1_host_{ item["name"] }',
+                    template=template,
+                    additional_vars={'item': item},
+                    basename_key=item['name'],
+                )
+            )
+    else:
+        data = make_data()
+        for item in items:
+            issues.append(
+                wt.JiraIssue(
+                    name=f'1_host_{ item["name"] }',
+                    common_vars=common_vars,
+                    additional_vars={'item': item},
+                    data=data.copy(),
+                    fromfile='1_host.jira.yaml',
+                    basename='1_host',
+                    basename_key=item['name'],
+                    jira='https://jira.example.com/',
+                )
+            )
+    return issues
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    common_vars = {
+        'release': '1.0',
+        'hosts': [
+            {'name': f'h{ i }', 'owner': f'user{ i % 10 }'} for i in range(count)
+        ],
+    }
+    # names are part of the workload, not of issues
+    names = [f'1_host_{ item["name"] }' for item in common_vars['hosts']]
+
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    issues = create_issues(count, common_vars)
+    created, _ = tracemalloc.get_traced_memory()
+    for issue, name in zip(issues, names):
+        issue.id = f'PRJ-{ name }'
+    with_ids, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'issues:                 {count}')
+    print(f'bytes per issue:        {(created - before) / count:.0f}')
+    # includes issuekey_ entries in common_vars which don't depend on Issue
+    print(f'bytes per issue w/ ids: {(with_ids - before) / count:.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+'''Cold start time of workflow-templater
+
+Usage: benchmarks/startup.py [--runs N] [--top N] [--max-import-ms MS]
+
+Prints import time of workflow_templater (from python -X importtime) with the
+slowest modules, wall time of a few typical invocations and fails (exit code 1)
+if backend dependencies are imported eagerly again or if import takes longer
+than --max-import-ms.
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+SCRIPT = os.path.join(ROOT, 'workflow_templater', '__init__.py')
+EXAMPLE = os.path.join(ROOT, 'examples', 'basic_release_example')
+
+# must be imported only when a template of that type, network or keyring is used
+LAZY_MODULES = (
+    'keyring',
+    'smtplib',
+    'email.mime.text',
+    'http.client',
+    'http.server',
+    'urllib.request',
+    'natsort',
+    'ruamel.yaml',
+)
+
+
+def import_times():
+    '''Returns {module: (self us, cumulative us)} for "import workflow_templater"'''
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import workflow_templater'],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:') :].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def eagerly_imported():
+    code = (
+        'import sys, workflow_templater; '
+        f'print(" ".join(m for m in {LAZY_MODULES!r} if m in sys.modules))'
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.split()
+
+
+def wall_time(args, runs, env):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, SCRIPT, *args],
+            cwd=ROOT,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--max-import-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    times = import_times()
+    total_ms = times['workflow_templater'][1] / 1000
+    print(f'import workflow_templater: {total_ms:.1f} ms')
+    print(f'slowest modules (cumulative, top {args.top}):')
+    slowest = sorted(times.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (_, cumulative_us) in slowest[1 : args.top + 1]:
+        print(f'  {cumulative_us / 1000:8.1f} ms  {name}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # don't touch user's caches and config
+        env = dict(os.environ, XDG_CACHE_HOME=tmp, XDG_CONFIG_HOME=tmp)
+        print(f'wall time, median of {args.runs} runs:')
+        for title, cmd in (
+            ('--help', ['--help']),
+            ('--print-config-path', ['--print-config-path', EXAMPLE]),
+            ('--dry-run example', ['--dry-run', EXAMPLE]),
+        ):
+            print(f'  {wall_time(cmd, args.runs, env) * 1000:8.1f} ms  {title}')
+
+    failed = False
+    eager = eagerly_imported()
+    if eager:
+        print(f'FAIL: imported at startup: {", ".join(eager)}')
+        failed = True
+    if args.max_import_ms is not None and total_ms > args.max_import_ms:
+        print(f'FAIL: import takes more than {args.max_import_ms} ms')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,36 +5,105 @@ import json
 import logging
 import os
 import sys
+import threading
+from collections import ChainMap
 from functools import partial
-from itertools import chain
+from itertools import chain, count
 from shlex import quote
-from typing import Any, Optional, Sequence, cast
-
-import ruamel.yaml
+from typing import Any, NamedTuple, Optional, Sequence, cast
 
 if __name__ == '__main__':
     # preserve ability to launch this script (__main__.py) directly
-    from common import pretty_dump
-    from our_jinja import OurJinjaEnvironment, OurJinjaLoader
+    import yaml_cache
+    from common import LazyDump
+    from journal import Journal, ResumedRun
+    from our_jinja import (
+        OurBytecodeCache,
+        OurJinjaEnvironment,
+        OurJinjaLoader,
+        TemplateReferences,
+        analyze_template,
+        compile_template,
+        referenced_variables,
+        render_template,
+    )
     from quote_windows import escape_cmd, escape_ps
-    from urlopen_jira import get_password, urlopen_jira
+    from scheduler import (
+        CreationScheduler,
+        StreamingPipeline,
+        references_issuekeys,
+        update_issues,
+    )
+    from state import PushedState, payload_hash
+    from timings import Timings, current_timings, measure, phase
 else:
-    from .urlopen_jira import urlopen_jira, get_password
-    from .our_jinja import OurJinjaEnvironment, OurJinjaLoader
+    from .state import PushedState, payload_hash
+    from .journal import Journal, ResumedRun
+    from .our_jinja import (
+        OurBytecodeCache,
+        OurJinjaEnvironment,
+        OurJinjaLoader,
+        TemplateReferences,
+        analyze_template,
+        compile_template,
+        referenced_variables,
+        render_template,
+    )
     from .quote_windows import escape_cmd, escape_ps
-    from .common import pretty_dump
+    from .scheduler import (
+        CreationScheduler,
+        StreamingPipeline,
+        references_issuekeys,
+        update_issues,
+    )
+    from .common import LazyDump
+    from .timings import Timings, current_timings, measure, phase
+    from . import yaml_cache
 
 import datetime
+import hashlib
 import importlib.util
-import smtplib
-from email.mime.text import MIMEText
 
-from appdirs import user_config_dir
+from appdirs import user_cache_dir, user_config_dir
 from jinja2 import StrictUndefined, Undefined
 from jinja2.utils import missing, object_type_repr
-from natsort import natsorted
 
-yaml = ruamel.yaml.YAML(typ='safe')
+
+def import_our_module(name):
+    '''
+    Backends (network, keyring, SMTP, server) and their dependencies are slow
+    to import, so they are imported only when they're actually used
+    '''
+    if __package__:
+        return importlib.import_module(f'.{name}', __package__)
+    # launched as a script, see above
+    return importlib.import_module(name)
+
+
+def urlopen_jira(*args, **kwargs):
+    return import_our_module('urlopen_jira').urlopen_jira(*args, **kwargs)
+
+
+# ruamel.yaml keeps state of parsing in YAML instance, so runs of WorkflowEngine
+# in different threads need different ones
+yaml_loaders = threading.local()
+
+
+def safe_yaml():
+    try:
+        return yaml_loaders.safe
+    except AttributeError:
+        import ruamel.yaml
+
+        yaml_loaders.safe = ruamel.yaml.YAML(typ='safe')
+        return yaml_loaders.safe
+
+
+def parse_yaml(text):
+    return safe_yaml().load(text)
+
+
+CACHE_DIR = user_cache_dir('workflow-templater')
 
 COMMON_VARS_FILES = (
     '0_common.yaml',
@@ -56,9 +125,16 @@ NO_UPDATE_MARKER = '_workflow_templater_no_update'
 FORCE_NO_UPDATE_MARKER = '_workflow_templater_force_no_update'
 
 
+undefined_counter = threading.local()
+
+
 class ChainableDebugUndefined(Undefined):
     '''Not fully tested and well thought but should work for basic cases'''
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        undefined_counter.value = getattr(undefined_counter, 'value', 0) + 1
+
     def __getattr__(self, attr: str) -> 'ChainableDebugUndefined':
         return ChainableDebugUndefined(
             hint=self._undefined_hint,
@@ -86,14 +162,32 @@ class ChainableDebugUndefined(Undefined):
 
 
 def jinja_render_recursive(
-    env, what, vars, path, updating_while_creating=False, updating=False
+    env,
+    what,
+    vars,
+    path,
+    updating_while_creating=False,
+    updating=False,
+    remember=None,
+    reuse=None,
 ):
+    '''
+    remember: dict to save results of strings which would render the same way later
+      (no undefined values and no issuekey_ variables involved), reuse: such dict
+      from the previous rendering of the same data
+    '''
     if isinstance(what, list):
         newlist = []  # not using map here because we need index for error message
         for i, item in enumerate(what):
             try:
                 result = jinja_render_recursive(
-                    env, item, vars, path + ['[{}]'.format(i)], updating_while_creating
+                    env,
+                    item,
+                    vars,
+                    path + ['[{}]'.format(i)],
+                    updating_while_creating,
+                    remember=remember,
+                    reuse=reuse,
                 )
                 try:
                     for marker, situation in (
@@ -115,7 +209,13 @@ def jinja_render_recursive(
         for k, v in what.items():
             try:
                 new_value = jinja_render_recursive(
-                    env, v, vars, path + [k], updating_while_creating
+                    env,
+                    v,
+                    vars,
+                    path + [k],
+                    updating_while_creating,
+                    remember=remember,
+                    reuse=reuse,
                 )
                 try:
                     for marker, situation in (
@@ -133,13 +233,21 @@ def jinja_render_recursive(
                 pass
         return newdict
     elif isinstance(what, str):
+        if reuse is not None and tuple(path) in reuse:
+            return reuse[tuple(path)]
         try:
-            result = env.from_string(what).render(vars)
+            undefined_before = getattr(undefined_counter, 'value', 0)
+            result = render_template(compile_template(env, what), vars)
             JSONMARKER = '_workflow_templater_parsejson:'
             if result.startswith(JSONMARKER):
-                return json.loads(result[len(JSONMARKER) :])
-            else:
-                return result
+                result = json.loads(result[len(JSONMARKER) :])
+            if (
+                remember is not None
+                and getattr(undefined_counter, 'value', 0) == undefined_before
+                and not references_issuekeys(referenced_variables(env, what))
+            ):
+                remember[tuple(path)] = result
+            return result
         except Exception as e:
             logging.critical(
                 'Template error in {path}: {err}.'.format(
@@ -152,13 +260,43 @@ def jinja_render_recursive(
         return what
 
 
+def analyze_recursive(env, what):
+    '''Union of analyze_template of all strings inside what, None if unknown'''
+    if isinstance(what, str):
+        return analyze_template(env, what)
+    elif isinstance(what, list):
+        items = what
+    elif isinstance(what, dict):
+        items = what.values()
+    else:
+        return TemplateReferences(frozenset(), frozenset())
+    variables = set()
+    templates = set()
+    for item in items:
+        references = analyze_recursive(env, item)
+        if references is None:
+            return None
+        variables |= references.variables
+        templates |= references.templates
+    return TemplateReferences(frozenset(variables), frozenset(templates))
+
+
+def referenced_variables_recursive(env, what):
+    references = analyze_recursive(env, what)
+    return None if references is None else references.variables
+
+
 ASKMARKER = '_workflow_templater_ask:'
 
 
-def process_vars(v, label):
+def process_vars(v, label, interactive=True):
     if isinstance(v, str):
         if v.startswith(ASKMARKER):
             type_ = v.replace(ASKMARKER, '')
+            if not interactive:
+                raise Exception(
+                    f'{label} has to be entered interactively ({ASKMARKER}), pass its value in vars'
+                )
             if type_ == 'bool':
                 v = input(f'{label} (y/yes/n/no)?: ').strip().lower() in (
                     'y',
@@ -174,46 +312,96 @@ def process_vars(v, label):
     elif isinstance(v, list):
         newlist = []
         for index, item in enumerate(v):
-            newlist.append(process_vars(item, f'{label}[{index}]'))
+            newlist.append(process_vars(item, f'{label}[{index}]', interactive))
         return newlist
     elif isinstance(v, dict):
         return dict(
-            map(lambda t: (t[0], process_vars(t[1], f'{label}.{t[0]}')), v.items())
+            map(
+                lambda t: (t[0], process_vars(t[1], f'{label}.{t[0]}', interactive)),
+                v.items(),
+            )
         )
     else:
         return v
 
 
+class JiraConfig(NamedTuple):
+    jira: str
+
+
+class EmailConfig(NamedTuple):
+    smtp: str
+    user: Optional[str]
+    keyring_service: str
+    email_from: str
+    starttls: bool = True
+
+
+class IssueTemplate:
+    '''Everything issues from the same template file have in common, shared by all of them'''
+
+    def __init__(self, data, fromfile, basename, common_vars, is_dryrun, config, run):
+        self.data = data
+        self.fromfile = fromfile
+        self.basename = basename
+        self.common_vars = common_vars
+        self.is_dryrun = is_dryrun
+        self.config = config
+        self.run = run
+
+
+class JiraIssueTemplate(IssueTemplate):
+    def __init__(self, data, *args):
+        super().__init__(data, *args)
+        self.update_fields = data.pop('update', None)
+        self.watchers = data.pop('watchers', ())
+
+
 class Issue:
+    # there may be tens of thousands of issues (foreach), so keep them small
+    __slots__ = (
+        'name',
+        'template',
+        'final_vars',
+        'no_update',
+        'updating',
+        'basename_key',
+        '_id',
+        'fingerprint',
+        'rendered',
+    )
+    Template = IssueTemplate
+
     def __init__(
         self,
         name,
-        common_vars,
+        template,
         additional_vars,
-        data,
-        fromfile,
         id=None,
-        is_dryrun=False,
         no_update=False,
         updating=False,
-        basename=None,
         basename_key=None,
     ):
         self.name = name
-        self.fromfile = fromfile
-        self.common_vars = common_vars
-        self.additional_vars = additional_vars  # TODO: remove them? Don't forget about foreach_key and shit
-        self.data = data
-        self.is_dryrun = is_dryrun
+        self.template = template
+        # additional_vars (TODO: remove them? Don't forget about foreach_key and shit)
+        # get issuekey_self once the id is known
+        self.final_vars = ChainMap(additional_vars, template.common_vars)
         self.no_update = no_update
         self.updating = updating
-        self.self_key_dict = {}
-        self.basename = basename
         self.basename_key = basename_key
-
-    @property
-    def final_vars(self):
-        return dict(**self.common_vars, **self.additional_vars, **self.self_key_dict)
+        self._id = None
+        self.fingerprint = None
+        # strings of data rendered by render_create() which don't need to be rendered again
+        self.rendered = None
+
+    additional_vars = property(lambda self: self.final_vars.maps[0])
+    data = property(lambda self: self.template.data)
+    fromfile = property(lambda self: self.template.fromfile)
+    basename = property(lambda self: self.template.basename)
+    common_vars = property(lambda self: self.template.common_vars)
+    is_dryrun = property(lambda self: self.template.is_dryrun)
+    run = property(lambda self: self.template.run)
 
     @property
     def id(self):
@@ -221,87 +409,223 @@ class Issue:
 
     @id.setter
     def id(self, id):
+        self.set_known_id(id)
+        if self.run.journal is not None:
+            self.run.journal.created(self.name, id, self.updating)
+
+    def set_known_id(self, id):
+        '''Sets id without writing it to the journal: ids from update are already there (see open_run_state)'''
         self._id = id
+        self.additional_vars['issuekey_self'] = id
         self.common_vars[f'issuekey_{ self.name }'] = id
         if self.basename and self.basename != self.name:
             assert self.basename_key
             if f'issuekey_{ self.basename }' not in self.common_vars:
                 self.common_vars[f'issuekey_{ self.basename }'] = {}
             self.common_vars[f'issuekey_{ self.basename }'][self.basename_key] = id
-        self.self_key_dict['issuekey_self'] = id
 
-    def update(self):
+    def creation_references(self):
+        '''Variables used by render_create(), None if unknown'''
+        return referenced_variables_recursive(self.run.jinja_env_permissive, self.data)
+
+    def render_create(self):
         raise NotImplementedError()
 
+    def send_create(self, payload):
+        '''Returns id of the new issue. Must not touch shared state: may run in another thread'''
+        raise NotImplementedError()
 
-class JiraIssue(Issue):
-    def __init__(
-        self,
-        name,
-        common_vars,
-        additional_vars,
-        data,
-        fromfile,
-        id=None,
-        is_dryrun=False,
-        no_update=False,
-        updating=False,
-        basename=None,
-        basename_key=None,
-        jira=None,
-    ):
-        super().__init__(
-            name,
-            common_vars,
-            additional_vars,
-            data,
-            fromfile,
-            id,
-            is_dryrun,
-            no_update,
-            updating,
-            basename,
-            basename_key,
+    # optional staticmethod (issues, payloads) -> list of ids or exceptions
+    send_create_batch = None
+
+    def create(self):
+        with measure('render', template=self.fromfile, stage='create', issue=self.name):
+            payload = self.render_create()
+        self.id = self.send_create(payload)
+
+    def update_template(self):
+        '''Everything that render_update() renders'''
+        return self.data
+
+    def update_references(self):
+        '''Variables used by render_update(), None if unknown'''
+        return referenced_variables_recursive(
+            self.run.jinja_env_strict, self.update_template()
         )
-        self.jira = jira
-        self.update_fields = self.data.pop('update', None)
-        self.watchers = self.data.pop('watchers', ())
 
-        if id is None:
-            fields = jinja_render_recursive(
-                jinja_env_permissive, self.data, self.final_vars, [self.fromfile]
-            )
-            if self.is_dryrun:
-                self.id = f'FAKE_JIRA_KEY-{ name }'
-                logging.info(pretty_dump(fields))
-            else:
-                # create issue
-                logging.info('creating issue for %s', name)
-                result, _ = urlopen_jira_wrap(
-                    'rest/api/2/issue/',
-                    'POST',
-                    {
-                        'fields': fields,
-                    },
+    def render_update(self):
+        raise NotImplementedError()
+
+    def inputs_fingerprint(self):
+        '''Hash of templates and values of variables used by render_update(), None if unknown'''
+        env = self.run.jinja_env_strict
+        references = analyze_recursive(env, self.update_template())
+        if references is None:
+            return None
+        final_vars = self.final_vars
+        return payload_hash(
+            {
+                'template': self.update_template(),
+                'updating': self.updating,
+                'variables': {
+                    name: final_vars[name]
+                    for name in references.variables
+                    if name in final_vars
+                },
+                'includes': {
+                    name: env.loader.get_source(env, name)[0]
+                    for name in references.templates
+                },
+            }
+        )
+
+    def needs_update(self):
+        if self.no_update:
+            return False
+        pushed_state = self.run.pushed_state
+        if self.run.incremental and pushed_state is not None and not self.is_dryrun:
+            self.fingerprint = self.inputs_fingerprint()
+            if self.fingerprint is not None and self.fingerprint == pushed_state.get(
+                'inputs', self.state_scope(), self.id
+            ):
+                logging.info(
+                    '%s %s: templates and variables have not changed, skipping',
+                    self.id,
+                    self.name,
                 )
-                self.id = result['key']
-                logging.info('created issue for %s, key: %s', name, self.id)
+                return False
+        return True
+
+    def state_scope(self):
+        '''Where ids of this type of issues are unique, for PushedState'''
+        raise NotImplementedError()
+
+    def push_update(self, payload):
+        '''Must not touch shared state: may run in another thread'''
+        raise NotImplementedError()
+
+    def send_update(self, payload):
+        pushed_state = self.run.pushed_state
+        if self.is_dryrun or pushed_state is None:
+            self.push_update(payload)
+            return
+        digest = payload_hash(payload)
+        if (
+            self.run.skip_unchanged
+            and pushed_state.get('payload', self.state_scope(), self.id) == digest
+        ):
+            logging.info('%s %s has not changed, skipping', self.id, self.name)
         else:
-            self.id = id
+            self.push_update(payload)
+            pushed_state.set('payload', self.state_scope(), self.id, digest)
+        if self.fingerprint is not None:
+            pushed_state.set('inputs', self.state_scope(), self.id, self.fingerprint)
+
+    def finish_update(self, payload):
+        self.send_update(payload)
+        if self.run.journal is not None:
+            self.run.journal.updated(self.name)
 
     def update(self):
-        if self.no_update:
-            return
+        if self.needs_update():
+            with measure(
+                'render', template=self.fromfile, stage='update', issue=self.name
+            ):
+                payload = self.render_update()
+            self.finish_update(payload)
+
+
+class JiraIssue(Issue):
+    __slots__ = ()
+    Template = JiraIssueTemplate
+
+    def __init__(self, name, template, additional_vars, id=None, **kwargs):
+        super().__init__(name, template, additional_vars, id, **kwargs)
+        if id is not None:
+            self.set_known_id(id)
+
+    jira = property(lambda self: self.template.config.jira)
+    update_fields = property(lambda self: self.template.update_fields)
+    watchers = property(lambda self: self.template.watchers)
+
+    def render_create(self):
+        self.rendered = {}
+        return jinja_render_recursive(
+            self.run.jinja_env_permissive,
+            self.data,
+            self.final_vars,
+            [self.fromfile],
+            remember=self.rendered,
+        )
+
+    def send_create(self, fields):
+        if self.is_dryrun:
+            logging.info('%s', LazyDump(fields))
+            return f'FAKE_JIRA_KEY-{ self.name }'
+        # create issue
+        logging.info('creating issue for %s', self.name)
+        result, _ = self.run.urlopen_jira(
+            'rest/api/2/issue/',
+            'POST',
+            {
+                'fields': fields,
+            },
+        )
+        logging.info('created issue for %s, key: %s', self.name, result['key'])
+        return result['key']
+
+    @staticmethod
+    def send_create_batch(issues, fields_list):
+        if issues[0].is_dryrun:
+            return [
+                issue.send_create(fields) for issue, fields in zip(issues, fields_list)
+            ]
+        from urllib.error import HTTPError
+
+        logging.info(
+            'creating issues for %s', ', '.join(issue.name for issue in issues)
+        )
+        try:
+            result, _ = issues[0].run.urlopen_jira(
+                'rest/api/2/issue/bulk',
+                'POST',
+                {
+                    'issueUpdates': [{'fields': fields} for fields in fields_list],
+                },
+            )
+        except HTTPError as e:
+            # nothing has been created, details are already logged by urlopen_jira
+            return [e] * len(issues)
+        errors = {
+            error['failedElementNumber']: error for error in result.get('errors', ())
+        }
+        created = iter(result['issues'])
+        keys = []
+        for number, issue in enumerate(issues):
+            if number in errors:
+                keys.append(Exception(json.dumps(errors[number].get('elementErrors'))))
+            else:
+                key = next(created)['key']
+                logging.info('created issue for %s, key: %s', issue.name, key)
+                keys.append(key)
+        return keys
+
+    def update_template(self):
+        return [self.data, self.update_fields, self.watchers]
+
+    def render_update(self):
         fields = jinja_render_recursive(
-            jinja_env_strict,
+            self.run.jinja_env_strict,
             self.data,
             self.final_vars,
             [self.fromfile],
             self.updating,
             True,
+            reuse=self.rendered,
         )
+        self.rendered = None
         update = jinja_render_recursive(
-            jinja_env_strict,
+            self.run.jinja_env_strict,
             self.update_fields,
             self.final_vars,
             [self.fromfile],
@@ -309,20 +633,27 @@ class JiraIssue(Issue):
             True,
         )
         watchers = jinja_render_recursive(
-            jinja_env_strict,
+            self.run.jinja_env_strict,
             self.watchers,
             self.final_vars,
             [self.fromfile],
             self.updating,
             True,
         )
+        return fields, update, watchers
+
+    def state_scope(self):
+        return self.jira
+
+    def push_update(self, payload):
+        fields, update, watchers = payload
         if self.is_dryrun:
             pass
             logging.info('-----{}-----'.format(self.id))
-            logging.info(pretty_dump(fields))
+            logging.info('%s', LazyDump(fields))
             if update:
-                logging.info(pretty_dump(update))
-            logging.info(pretty_dump({'watchers': watchers}))
+                logging.info('%s', LazyDump(update))
+            logging.info('%s', LazyDump({'watchers': watchers}))
         else:
             if not isinstance(update, list):
                 # some actions in jira, despite being a list, may contain only one item, for example "issuelinks"
@@ -330,7 +661,7 @@ class JiraIssue(Issue):
                 update = [update]
             for i, u in enumerate(update):
                 logging.info('updating issue %s (%s) %s', self.id, i + 1, self.name)
-                urlopen_jira_wrap(
+                self.run.urlopen_jira(
                     f'rest/api/2/issue/{self.id}',
                     'PUT',
                     {
@@ -340,66 +671,57 @@ class JiraIssue(Issue):
                 )
             for watcher in watchers:
                 logging.info('adding watcher %s to %s %s', watcher, self.id, self.name)
-                urlopen_jira_wrap(
+                self.run.urlopen_jira(
                     f'rest/api/2/issue/{self.id}/watchers', 'POST', watcher
                 )
 
 
 class EmailIssue(Issue):
-    def __init__(
-        self,
-        name,
-        common_vars,
-        additional_vars,
-        data,
-        fromfile,
-        id=None,
-        is_dryrun=False,
-        no_update=False,
-        updating=False,
-        basename=None,
-        basename_key=None,
-        smtp=None,
-        user=None,
-        keyring_service=None,
-        email_from=None,
-    ):
-        super().__init__(
-            name,
-            common_vars,
-            additional_vars,
-            data,
-            fromfile,
-            id,
-            is_dryrun,
-            no_update,
-            updating,
-            basename,
-            basename_key,
-        )
-        self.smtp = smtp
-        self.user = user
-        self.email_from = email_from
-        self.keyring_service = keyring_service
-        self.id = jinja_render_recursive(
-            jinja_env_permissive, self.data, self.final_vars, [self.fromfile]
+    __slots__ = ()
+
+    smtp = property(lambda self: self.template.config.smtp)
+    user = property(lambda self: self.template.config.user)
+    keyring_service = property(lambda self: self.template.config.keyring_service)
+    email_from = property(lambda self: self.template.config.email_from)
+    starttls = property(lambda self: self.template.config.starttls)
+
+    def render_create(self):
+        self.rendered = {}
+        return jinja_render_recursive(
+            self.run.jinja_env_permissive,
+            self.data,
+            self.final_vars,
+            [self.fromfile],
+            remember=self.rendered,
         )['Message-ID']
 
-    def update(self):
-        if self.no_update:
-            return
+    def send_create(self, message_id):
+        # nothing to create, email is sent during update
+        return message_id
+
+    def render_update(self):
         rendered = jinja_render_recursive(
-            jinja_env_strict,
+            self.run.jinja_env_strict,
             self.data,
             self.final_vars,
             [self.fromfile],
             self.updating,
             True,
+            reuse=self.rendered,
         )
+        self.rendered = None
         self.id = rendered['Message-ID']
+        return rendered
+
+    def state_scope(self):
+        return self.smtp
+
+    def push_update(self, rendered):
         if self.is_dryrun:
-            logging.info('Email: {}'.format(pretty_dump(rendered)))
+            logging.info('Email: %s', LazyDump(rendered))
         else:
+            from email.mime.text import MIMEText
+
             logging.info('sending email from %s', self.name)
             if 'Body_html' in rendered:
                 msg = MIMEText(rendered.pop('Body_html'), 'html')
@@ -418,15 +740,10 @@ class EmailIssue(Issue):
                 if v:
                     msg[h] = v
 
-            with smtplib.SMTP(
-                self.smtp.split(':')[0], int(self.smtp.split(':')[1])
-            ) as s:
-                s.starttls()
-                # TODO: handle bad password here
-                logging.debug(
-                    s.login(self.user, get_password(self.keyring_service, self.user))
-                )
-                s.send_message(msg)
+            with measure('smtp', issue=self.name):
+                self.run.engine.smtp_session(
+                    self.smtp, self.user, self.keyring_service, self.starttls
+                ).send_message(msg)
             logging.info(
                 'sent email from %s\nSubject: %s\nTo: %s\nMessage-Id: %s',
                 self.name,
@@ -442,32 +759,485 @@ ISSUE_TYPES = {
 }
 
 
-def prepare_future_update_cmd(issues, common_vars, updating):
-    future_update_arg = json.dumps(
-        dict(map(lambda issue: (issue.name, issue.id), issues))
-    )
-    update_issues_cmd_parts = sys.argv[1:].copy()
-    if updating:
-        for i, arg in enumerate(update_issues_cmd_parts):
-            if arg == '--update':
-                update_issues_cmd_parts[i + 1] = future_update_arg
-                break
-    else:
-        update_issues_cmd_parts.insert(0, '--update')
-        update_issues_cmd_parts.insert(1, future_update_arg)
-    cmd_cmd = ' '.join(
-        chain(
-            (os.path.basename(sys.argv[0]),), map(escape_cmd, update_issues_cmd_parts)
+class WorkflowResult(NamedTuple):
+    # issue name: jira issue key or email Message-ID
+    ids: dict
+    # command to update these issues later for the current shell, see WorkflowRun
+    update_cmd: str
+
+
+class WorkflowEngine:
+    '''
+    Renders and sends template dirs. One engine may run many of them, one
+    after another or at the same time from different threads, keeping warm
+    everything which doesn't depend on a particular run: parsed YAML, compiled
+    templates and SMTP sessions. HTTP connections and credentials are shared by
+    the whole process anyway (see urlopen_jira).
+
+        engine = WorkflowEngine(jira='https://jira.example.com', jira_user='user')
+        result = engine.run('release_templates', {'version': '2.0'})
+        ...
+        engine.close()
+
+    Options have the same meaning as command line arguments, *_dir=None
+    disables the corresponding cache, pushed state or default journal.
+    '''
+
+    def __init__(
+        self,
+        jira=None,
+        jira_user=None,
+        jira_keyring_service_name=None,
+        access_token=None,
+        email_smtp=None,
+        email_user=None,
+        email_keyring_service_name=None,
+        email_from=None,
+        email_starttls=True,
+        dry_run=False,
+        concurrency=1,
+        bulk_create=0,
+        stream=0,
+        skip_unchanged=False,
+        incremental=False,
+        yaml_cache_dir=os.path.join(CACHE_DIR, 'yaml'),
+        jinja_cache_dir=os.path.join(CACHE_DIR, 'jinja'),
+        state_dir=os.path.join(CACHE_DIR, 'pushed_state'),
+        journal_dir=os.path.join(CACHE_DIR, 'journals'),
+    ):
+        if jira_keyring_service_name is None:
+            jira_keyring_service_name = jira
+        if email_keyring_service_name is None:
+            email_keyring_service_name = email_smtp
+        self.dry_run = dry_run
+        self.concurrency = concurrency
+        self.bulk_create = bulk_create
+        self.stream = stream
+        self.skip_unchanged = skip_unchanged
+        self.incremental = incremental
+        self.yaml_cache_dir = yaml_cache_dir
+        self.state_dir = state_dir
+        self.journal_dir = journal_dir
+        self.urlopen_jira = partial(
+            urlopen_jira,
+            user=jira_user,
+            jira_base=jira,
+            keyring_service=jira_keyring_service_name,
+            access_token=access_token,
+        )
+        self.backend_configs = {
+            JiraIssue: JiraConfig(jira),
+            EmailIssue: EmailConfig(
+                email_smtp,
+                email_user,
+                email_keyring_service_name,
+                email_from,
+                email_starttls,
+            ),
+        }
+        self.smtp_sessions = None
+        self.jinja_bytecode_cache = (
+            None if jinja_cache_dir is None else OurBytecodeCache(jinja_cache_dir)
         )
+        self.jinja_envs = {}
+        self.lock = threading.Lock()
+        self.run_numbers = count(1)
+
+    def load_yaml(self, path):
+        return yaml_cache.load(parse_yaml, path, self.yaml_cache_dir)
+
+    def jinja_environments(self, template_dir):
+        '''(permissive, strict) environments for template_dir which see the current version of files'''
+        key = os.path.realpath(template_dir)
+        with self.lock:
+            if key not in self.jinja_envs:
+                # templates compile to the same code regardless of undefined, so both
+                # environments share source and bytecode caches
+                loader = OurJinjaLoader(template_dir)
+                self.jinja_envs[key] = tuple(
+                    OurJinjaEnvironment(
+                        loader=loader,
+                        bytecode_cache=self.jinja_bytecode_cache,
+                        undefined=undefined,
+                    )
+                    for undefined in (ChainableDebugUndefined, StrictUndefined)
+                )
+            else:
+                self.jinja_envs[key][0].loader.reset()
+            return self.jinja_envs[key]
+
+    def workflow(self, template_dir, vars=None, update=None, **options):
+        return WorkflowRun(self, template_dir, vars, update, **options)
+
+    def run(self, template_dir, vars=None, update=None, **options):
+        '''Runs template_dir, see WorkflowRun for arguments, returns WorkflowResult'''
+        return self.workflow(template_dir, vars, update, **options).execute()
+
+    def smtp_session(self, smtp, user, keyring_service, starttls=True):
+        with self.lock:
+            if self.smtp_sessions is None:
+                self.smtp_sessions = import_our_module('smtp_session').SMTPSessions()
+        return self.smtp_sessions.get(smtp, user, keyring_service, starttls)
+
+    def close(self):
+        if self.smtp_sessions is not None:
+            self.smtp_sessions.close()
+
+
+class WorkflowRun:
+    '''
+    One run of template_dir by WorkflowEngine. If execute() fails, the state
+    of the run (issues, journal) is still here to tell how to continue.
+
+    vars: variables which override the ones from vars_file (*common.yaml by default)
+    update: {issue name: id} of existing issues to update instead of creating them
+    resume: journal of the interrupted run to continue
+    journal: where to record progress, by default a new file in engine's
+      journal_dir; only that file or the resumed journal is removed after
+      successful run
+    update_cmd: function({issue name: id}) returning command which updates these
+      issues for the current shell and for all shells (update_issues_cmd
+      variable), both are JSON of ids (value for update) by default
+    dry_run: overrides engine's dry_run
+    interactive: whether values of _workflow_templater_ask: variables may be
+      asked on the terminal, otherwise such variables are an error
+    timings: Timings to record durations of phases, renders and requests to
+      (see timings.py), by default the one of the current context if any
+    '''
+
+    def __init__(
+        self,
+        engine,
+        template_dir,
+        vars=None,
+        update=None,
+        vars_file=None,
+        resume=None,
+        journal=None,
+        update_cmd=None,
+        dry_run=None,
+        timings=None,
+        interactive=True,
+    ):
+        self.engine = engine
+        self.template_dir = template_dir
+        self.vars = vars
+        self.vars_file = vars_file
+        self.update = update
+        self.resume = resume
+        self.journal_path = journal
+        self.update_cmd = update_cmd
+        self.dry_run = engine.dry_run if dry_run is None else dry_run
+        self.timings = timings
+        self.interactive = interactive
+        self.skip_unchanged = engine.skip_unchanged
+        self.incremental = engine.incremental
+        self.urlopen_jira = engine.urlopen_jira
+        self.common_vars = {}
+        self.issues = []
+        self.ids = {}
+        self.journal = None
+        self.pushed_state = None
+        self.jinja_env_permissive = None
+        self.jinja_env_strict = None
+
+    def execute(self):
+        if self.timings is not None:
+            token = current_timings.set(self.timings)
+        try:
+            self.load_vars()
+            with phase('prepare'):
+                self.open_run_state()
+            result = self.create_and_update()
+        except BaseException:
+            if self.pushed_state is not None:
+                self.pushed_state.save()
+            if self.journal is not None:
+                self.journal.close()
+            raise
+        finally:
+            if self.timings is not None:
+                current_timings.reset(token)
+        if self.pushed_state is not None:
+            self.pushed_state.save()
+        if self.journal is not None:
+            # journal given by the caller is theirs to keep
+            self.journal.close(
+                remove=self.resume is not None or self.journal_path is None
+            )
+        logging.debug('template cache: %s', compile_template.cache_info())
+        return result
+
+    def load_vars(self):
+        common_vars = {}
+        with phase('load vars'):
+            if self.vars_file:
+                common_vars = self.engine.load_yaml(
+                    os.path.join(self.template_dir, self.vars_file)
+                )
+            else:
+                for common_vars_file in COMMON_VARS_FILES:
+                    try:
+                        common_vars = self.engine.load_yaml(
+                            os.path.join(self.template_dir, common_vars_file)
+                        )
+                    except FileNotFoundError:
+                        pass
+            if self.vars:
+                common_vars.update(self.vars)
+
+        with phase('process_vars'):
+            common_vars = process_vars(common_vars, 'common_vars', self.interactive)
+        mutate_pyfile = os.path.join(self.template_dir, 'mutate.py')
+        if os.path.isfile(mutate_pyfile):
+            with phase('mutate.py'):
+                spec = importlib.util.spec_from_file_location(
+                    "mutate_module", mutate_pyfile
+                )
+                mutate_module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(mutate_module)
+                common_vars = mutate_module.mutate(common_vars)
+        logging.debug('-- common_vars --\n\n%s', LazyDump(common_vars))
+        self.common_vars = common_vars
+
+    def open_run_state(self):
+        engine = self.engine
+        common_vars = self.common_vars
+        self.updating_names = set()
+        self.finished = set()
+        if self.resume:
+            resumed = ResumedRun(self.resume)
+            self.update = resumed.ids
+            self.updating_names = resumed.updating_names
+            self.finished = resumed.updated
+            if resumed.updating is not None:
+                common_vars['updating'] = resumed.updating
+        elif self.update is not None:
+            self.updating_names = set(self.update)
+            common_vars['updating'] = datetime.datetime.timestamp(
+                datetime.datetime.utcnow()
+            )
+        else:
+            self.update = {}
+
+        if not self.dry_run:
+            journal_path = self.resume or self.journal_path
+            if journal_path is None and engine.journal_dir is not None:
+                journal_path = os.path.join(
+                    engine.journal_dir,
+                    '{}-{}-{}-{}.jsonl'.format(
+                        os.path.basename(os.path.abspath(self.template_dir)),
+                        datetime.datetime.now().strftime('%Y%m%d-%H%M%S'),
+                        os.getpid(),
+                        next(engine.run_numbers),
+                    ),
+                )
+            if journal_path is not None:
+                self.journal = Journal(
+                    journal_path,
+                    common_vars.get('updating'),
+                    resume=bool(self.resume),
+                )
+                if self.update and not self.resume:
+                    # resumed journal already has them
+                    self.journal.known(self.update)
+
+        if not self.dry_run and engine.state_dir is not None:
+            self.pushed_state = PushedState(
+                os.path.join(
+                    engine.state_dir,
+                    '{}.json'.format(
+                        hashlib.sha256(
+                            os.path.abspath(self.template_dir).encode()
+                        ).hexdigest()
+                    ),
+                )
+            )
+
+        (
+            self.jinja_env_permissive,
+            self.jinja_env_strict,
+        ) = engine.jinja_environments(self.template_dir)
+
+    def future_update_cmd(self):
+        '''Sets update_issues_cmd variable, returns command to update issues created so far for the current shell'''
+        self.ids = {
+            issue.name: issue.id for issue in self.issues if issue.id is not None
+        }
+        if self.update_cmd is None:
+            current_shell_cmd = update_issues_cmd = json.dumps(self.ids)
+        else:
+            current_shell_cmd, update_issues_cmd = self.update_cmd(self.ids)
+        self.common_vars['update_issues_cmd'] = update_issues_cmd
+        return current_shell_cmd
+
+    def create_and_update(self):
+        engine = self.engine
+        scheduler = CreationScheduler(engine.concurrency, engine.bulk_create)
+        if engine.stream:
+            pipeline = StreamingPipeline(
+                scheduler, engine.stream, engine.concurrency, self.common_vars
+            )
+            self.issues = pipeline.refs
+            with phase('create and update'):
+                for issue in self.expand_issues(pipeline.flush, pipeline.expanded):
+                    pipeline.add(issue)
+                pipeline.flush()
+            update_cmd = self.future_update_cmd()
+            with phase('update deferred'):
+                pipeline.update_deferred()
+        else:
+            with phase('create'):
+                for issue in self.expand_issues(scheduler.run):
+                    self.issues.append(issue)
+                    if issue.id is None:
+                        scheduler.add(issue)
+                scheduler.run()
+
+            update_cmd = self.future_update_cmd()
+
+            with phase('update'):
+                update_issues(self.issues, engine.concurrency)
+        return WorkflowResult(self.ids, update_cmd)
+
+    def expand_issues(self, flush, expanded=None):
+        '''
+        Yields issues from all templates, calls flush() when ids of all issues
+        yielded so far are required and expanded(basename) when all issues of
+        a template have been yielded
+        '''
+        common_vars = self.common_vars
+        update = self.update
+        updating_names = self.updating_names
+        from natsort import natsorted
+
+        for filename in natsorted(os.listdir(self.template_dir)):
+            for issue_type_ext, IssueType in ISSUE_TYPES.items():
+                if filename.endswith(issue_type_ext):
+                    data = self.engine.load_yaml(
+                        os.path.join(self.template_dir, filename)
+                    )
+
+                    if_jinja = data.pop('if', None)
+                    no_update = data.pop('no_update', False)
+                    force_no_update = data.pop('force_no_update', False)
+
+                    foreach_jinja = data.pop('foreach', (None,))
+                    if references_issuekeys(
+                        referenced_variables_recursive(
+                            self.jinja_env_strict, [if_jinja, foreach_jinja]
+                        )
+                    ):
+                        # values of issuekey_ variables are required right now
+                        flush()
+
+                    foreach = cast(
+                        Sequence[Optional[Any]],
+                        jinja_render_recursive(
+                            self.jinja_env_strict,
+                            foreach_jinja,
+                            common_vars,
+                            [filename, 'foreach'],
+                        ),
+                    )
+                    foreach_fromvar = data.pop('foreach_fromvar', None)
+                    if foreach_fromvar is not None:
+                        foreach = cast(
+                            Sequence[Optional[Any]], common_vars[foreach_fromvar]
+                        )  # should crash if not exists
+                    foreach_key = data.pop('foreach_key', 'item')
+                    foreach_namevar = data.pop('foreach_namevar', None)
+                    basename = filename.replace(issue_type_ext, '')
+                    template = IssueType.Template(
+                        data,
+                        filename,
+                        basename,
+                        common_vars,
+                        self.dry_run,
+                        self.engine.backend_configs[IssueType],
+                        self,
+                    )
+                    for i, item in enumerate(foreach):
+                        if foreach_namevar is not None:
+                            assert (
+                                item is not None
+                            ), 'Using foreach_namevar but no foreach/foreach_fromvar?'
+                            basename_key = item[foreach_namevar]
+                        else:
+                            basename_key = item
+
+                        name = basename
+                        if basename_key is not None:
+                            name += f'_{basename_key}'
+
+                        additional_vars = {}
+                        if item is not None:
+                            additional_vars[foreach_key] = item
+
+                        if if_jinja is not None:
+                            computed = jinja_render_recursive(
+                                self.jinja_env_strict,
+                                if_jinja,
+                                ChainMap(additional_vars, common_vars),
+                                [filename, 'if'],
+                            )
+                            if computed.lower() in ('false', 'no', ''):
+                                continue
+
+                        issue = IssueType(
+                            name=name,
+                            template=template,
+                            additional_vars=additional_vars,
+                            id=update[name] if name in update else None,
+                            no_update=(
+                                force_no_update
+                                if force_no_update
+                                else (no_update if name in updating_names else False)
+                            ),
+                            updating=name in updating_names,
+                            basename_key=basename_key,
+                        )
+                        if name in self.finished:
+                            # already updated before the interruption, see --resume
+                            issue.no_update = True
+                        yield issue
+                    if expanded is not None:
+                        expanded(basename)
+
+
+def replace_arg(cmd_parts, arg, value):
+    '''Returns copy of cmd_parts with option arg set to value (or removed if value is None)'''
+    result = []
+    found = False
+    skip_next = False
+    for part in cmd_parts:
+        if skip_next:
+            skip_next = False
+        elif part == arg or part.startswith(f'{arg}='):
+            skip_next = part == arg
+            if value is not None and not found:
+                result.extend((arg, value))
+            found = True
+        else:
+            result.append(part)
+    if value is not None and not found:
+        result[0:0] = (arg, value)
+    return result
+
+
+def prepare_cmd(cmd_parts):
+    '''Returns command line for the current shell and for all shells'''
+    cmd_cmd = ' '.join(
+        chain((os.path.basename(sys.argv[0]),), map(escape_cmd, cmd_parts))
     )
     powershell_cmd = ' '.join(
         (
             os.path.basename(sys.argv[0]),
-            escape_ps(update_issues_cmd_parts),
+            escape_ps(cmd_parts),
         )
     )
-    unixshell_cmd = ' '.join(chain((sys.argv[0],), map(quote, update_issues_cmd_parts)))
-    update_issues_cmd = '\n'.join(
+    unixshell_cmd = ' '.join(chain((sys.argv[0],), map(quote, cmd_parts)))
+    all_cmds = '\n'.join(
         (
             '',
             'For cmd.exe:',
@@ -480,23 +1250,109 @@ def prepare_future_update_cmd(issues, common_vars, updating):
             unixshell_cmd,
         )
     )
-    common_vars['update_issues_cmd'] = update_issues_cmd
     # Warning: parent shell detection here is very unreliable, for example, it will fail inside cygwin
     if os.name == 'nt' and 'PROMPT' in os.environ:  # hacky way to detect cmd.exe
-        return cmd_cmd
+        return cmd_cmd, all_cmds
     elif (
         os.name == 'nt'
     ):  # if we're not inside cmd.exe, let's assume that we're inside powershell
-        return powershell_cmd
+        return powershell_cmd, all_cmds
     elif os.name == 'posix':  # inside unix shell
-        return unixshell_cmd
+        return unixshell_cmd, all_cmds
     else:
-        return update_issues_cmd
+        return all_cmds, all_cmds
+
+
+def prepare_update_cmd(ids):
+    return prepare_cmd(
+        replace_arg(
+            replace_arg(sys.argv[1:], '--resume', None), '--update', json.dumps(ids)
+        )
+    )
+
+
+def prepare_resume_cmd(journal_path):
+    return prepare_cmd(
+        replace_arg(
+            replace_arg(sys.argv[1:], '--update', None), '--resume', journal_path
+        )
+    )[0]
+
+
+def resolve_options(options):
+    '''
+    Renders jinja in config/args values which may refer to each other: each value
+    once, after the values it refers to. Crashes if something is undefined or
+    values refer to each other in a cycle.
+    '''
+    env = OurJinjaEnvironment(undefined=StrictUndefined)
+    resolved = dict(options)
+    done = {}  # key: False while its dependencies are being rendered, True after
+
+    def resolve(key, path):
+        if done.get(key):
+            return
+        if key in done:
+            cycle = path[path.index(key) :] + [key]
+            raise Exception(
+                'config&args: circular reference: {}'.format(' -> '.join(cycle))
+            )
+        done[key] = False
+        # unknown (None) only for includes which fail anyway as there is no loader
+        for name in sorted(referenced_variables_recursive(env, options[key]) or ()):
+            if name in options:
+                resolve(name, path + [key])
+        resolved[key] = jinja_render_recursive(
+            env, options[key], resolved, ['config&args:', key]
+        )
+        done[key] = True
+
+    for key in options:
+        resolve(key, [])
+    return resolved
+
+
+PROFILE_MODES = ('cpu', 'memory')
+
+
+def add_profile_arguments(parser):
+    parser.add_argument(
+        '--profile',
+        choices=PROFILE_MODES,
+        help='run under cProfile and write pstats file (cpu) or under tracemalloc and write memory allocated at the peak of the run by modules and lines (memory)',
+    )
+    parser.add_argument(
+        '--profile-output',
+        type=str,
+        metavar='FILE',
+        help='where to write --profile results, default is workflow-templater.pstats (cpu) or workflow-templater-memory.txt (memory) in the current dir',
+    )
 
 
 def main():
+    # profiler has to be started before everything else, so --profile is
+    # parsed separately from the other arguments
+    profile_parser = argparse.ArgumentParser(add_help=False)
+    add_profile_arguments(profile_parser)
+    profile_args, _ = profile_parser.parse_known_args(sys.argv[1:])
+    if profile_args.profile is None:
+        run_main()
+    else:
+        import_our_module('profiling').run(
+            profile_args.profile, profile_args.profile_output, run_main
+        )
+
+
+def run_main():
+    timings = Timings()
+    current_timings.set(timings)
+    # workflow-templater serve [options]: see server.py
+    serving = sys.argv[1:2] == ['serve']
+    argv = sys.argv[2:] if serving else sys.argv[1:]
     parser = argparse.ArgumentParser(
-        description='Workflow Templater', formatter_class=argparse.RawTextHelpFormatter
+        prog='workflow-templater serve' if serving else None,
+        description='Workflow Templater',
+        formatter_class=argparse.RawTextHelpFormatter,
     )
     parser.add_argument(
         '--dry-run',
@@ -530,6 +1386,17 @@ def main():
     parser.add_argument('--email-user', type=str)
     parser.add_argument('--email-keyring-service-name', type=str, default=None)
     parser.add_argument('--email-from', type=str)
+    parser.add_argument(
+        '--no-email-starttls',
+        action='store_false',
+        dest='email_starttls',
+        help='do not use STARTTLS (for local SMTP relays), without --email-user emails are also sent without login',
+    )
+    parser.add_argument(
+        '--email-starttls',
+        action='store_true',
+        help='use STARTTLS if it was disabled in config file (default)',
+    )
     default_config_path = os.path.join(
         user_config_dir('workflow-templater', roaming=True), 'config.yaml'
     )
@@ -545,65 +1412,186 @@ def main():
         help='print config file path and exit',
     )
     parser.add_argument('--access-token', type=str, default=None)
-    parser.add_argument('template_dir', type=str, help='path to dir with templates')
-    args = parser.parse_args()
-    if args.print_config_path:
-        print(args.config)
-        sys.exit(0)
-    if args.config:
-        try:
-            with open(os.path.expanduser(args.config), 'r', encoding='utf8') as f:
-                for k, v in yaml.load(f).items():
+    parser.add_argument(
+        '--stream',
+        type=int,
+        default=0,
+        metavar='N',
+        help='for huge foreach lists: create and update issues in chunks of N instead of creating all of them first, only names and keys of processed issues are kept in memory. Issues which use keys of not yet created issues or update_issues_cmd are updated at the end, issues which use issuekey_<name> of a foreach template are updated in the next chunk after all issues of that template have been created (so the ones which use issuekey_<name> of their own template are kept in memory until then).',
+    )
+    parser.add_argument(
+        '--journal',
+        type=str,
+        metavar='FILE',
+        help='where to record progress of the run for --resume, it is kept after successful run and replaced by the next run which uses it. By default a new file in the user cache dir which is removed after successful run',
+    )
+    parser.add_argument(
+        '--resume',
+        type=str,
+        metavar='JOURNAL',
+        help='continue interrupted run: use issues which have already been created and skip the ones which have already been updated. workflow-templater prints this command if something fails.',
+    )
+    parser.add_argument(
+        '--skip-unchanged',
+        action='store_true',
+        help='do not update issues and do not resend emails if exactly the same content has been sent to them last time',
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='do not even render issues and emails if their templates (including included files) and values of variables used in them have not changed since they have been sent last time',
+    )
+    parser.add_argument(
+        '--yaml-cache-dir',
+        type=str,
+        metavar='DIR',
+        default=os.path.join(user_cache_dir('workflow-templater'), 'yaml'),
+        help='where to keep parsed config, vars and templates to avoid parsing unchanged files again, default is %(default)s',
+    )
+    parser.add_argument(
+        '--no-yaml-cache',
+        action='store_true',
+        help='always parse YAML files, do not use --yaml-cache-dir',
+    )
+    parser.add_argument(
+        '--jinja-cache-dir',
+        type=str,
+        metavar='DIR',
+        default=os.path.join(user_cache_dir('workflow-templater'), 'jinja'),
+        help='where to keep compiled included/imported templates between runs, default is %(default)s',
+    )
+    parser.add_argument(
+        '--no-jinja-cache',
+        action='store_true',
+        help='do not use --jinja-cache-dir',
+    )
+    parser.add_argument(
+        '--state-dir',
+        type=str,
+        metavar='DIR',
+        default=os.path.join(user_cache_dir('workflow-templater'), 'pushed_state'),
+        help='where to remember what has been sent for --skip-unchanged and --incremental, default is %(default)s',
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=1,
+        metavar='N',
+        help='create and update up to N issues in parallel; issue which uses issuekey_ of another issue is still created after it',
+    )
+    parser.add_argument(
+        '--bulk-create',
+        type=int,
+        default=0,
+        metavar='N',
+        help='create jira issues which do not depend on each other in batches of up to N issues via bulk API (Jira allows up to 50)',
+    )
+    add_profile_arguments(parser)
+    parser.add_argument(
+        '--timings',
+        type=str,
+        metavar='FILE',
+        help='write durations of phases of the run, template renders, HTTP requests and emails with their percentiles to FILE as JSON lines',
+    )
+    if serving:
+        parser.add_argument(
+            '--listen',
+            type=str,
+            metavar='HOST:PORT',
+            default='127.0.0.1:8437',
+            help='where to accept run requests, default is %(default)s',
+        )
+        parser.add_argument(
+            '--token-file',
+            type=str,
+            metavar='FILE',
+            default=os.path.join(CACHE_DIR, 'server_token'),
+            help='where to write the token which requests must pass in "Authorization: Bearer <token>" header, readable only by the current user, a new token is generated on each start. Default is %(default)s',
+        )
+        parser.add_argument(
+            '--root',
+            type=str,
+            metavar='DIR',
+            action='append',
+            help='run only template dirs inside DIR, may be repeated, default is the current dir',
+        )
+    else:
+        parser.add_argument('template_dir', type=str, help='path to dir with templates')
+    with phase('config'):
+        args = parser.parse_args(argv)
+        if args.print_config_path:
+            print(args.config)
+            sys.exit(0)
+
+        def load_yaml(path):
+            return yaml_cache.load(
+                parse_yaml,
+                path,
+                None if args.no_yaml_cache else os.path.expanduser(args.yaml_cache_dir),
+            )
+
+        if args.config:
+            try:
+                for k, v in load_yaml(os.path.expanduser(args.config)).items():
                     parser.set_defaults(**{k: v})
-                args = (
-                    parser.parse_args()
+                args = parser.parse_args(
+                    argv
                 )  # re-parse args with new defaults from config
-        except FileNotFoundError:
-            if args.config != default_config_path:
-                raise
-
-    prev_iteration = None
-    while True:
-        # render jinja until nothing changes
-        args_result = jinja_render_recursive(
-            OurJinjaEnvironment(undefined=ChainableDebugUndefined),
-            prev_iteration if prev_iteration else vars(args),
-            prev_iteration if prev_iteration else vars(args),
-            ['config&args:'],
-        )
-        if args_result == prev_iteration:
-            break
-        prev_iteration = args_result
-    # do it one more time but crash if something left unexpanded
-    args_result = jinja_render_recursive(
-        OurJinjaEnvironment(undefined=StrictUndefined),
-        args_result,
-        args_result,
-        ['config&args:'],
-    )
-    for k, v in args_result.items():
-        setattr(args, k, v)
-
-    if args.jira_keyring_service_name is None:
-        args.jira_keyring_service_name = args.jira
-    if args.email_keyring_service_name is None:
-        args.email_keyring_service_name = args.email_smtp
-
-    global urlopen_jira_wrap  # get rid of it?
-    urlopen_jira_wrap = partial(
-        urlopen_jira,
-        user=args.jira_user,
-        jira_base=args.jira,
-        keyring_service=args.jira_keyring_service_name,
-        access_token=args.access_token,
-    )
+            except FileNotFoundError:
+                if args.config != default_config_path:
+                    raise
+
+        for k, v in resolve_options(vars(args)).items():
+            setattr(args, k, v)
+    if not args.timings:
+        current_timings.set(None)
 
     logging.basicConfig(
         level=logging.DEBUG if args.verbose else logging.INFO,
         format='%(levelname)s %(message)s',
     )
-    issues = []
-    common_vars = {}
+    engine = WorkflowEngine(
+        jira=args.jira,
+        jira_user=args.jira_user,
+        jira_keyring_service_name=args.jira_keyring_service_name,
+        access_token=args.access_token,
+        email_smtp=args.email_smtp,
+        email_user=args.email_user,
+        email_keyring_service_name=args.email_keyring_service_name,
+        email_from=args.email_from,
+        email_starttls=args.email_starttls,
+        dry_run=args.dry_run,
+        concurrency=int(args.concurrency),
+        bulk_create=int(args.bulk_create),
+        stream=int(args.stream),
+        skip_unchanged=args.skip_unchanged,
+        incremental=args.incremental,
+        yaml_cache_dir=(
+            None if args.no_yaml_cache else os.path.expanduser(args.yaml_cache_dir)
+        ),
+        jinja_cache_dir=(
+            None if args.no_jinja_cache else os.path.expanduser(args.jinja_cache_dir)
+        ),
+        state_dir=os.path.expanduser(args.state_dir),
+    )
+    if serving:
+        host, port = args.listen.rsplit(':', 1)
+        import_our_module('server').serve(
+            engine,
+            (host, int(port)),
+            os.path.expanduser(args.token_file),
+            [os.path.expanduser(root) for root in args.root or [os.getcwd()]],
+        )
+        return
+
+    workflow = engine.workflow(
+        args.template_dir,
+        vars_file=args.vars,
+        update=json.loads(args.update) if args.update else None,
+        resume=args.resume,
+        journal=args.journal,
+        update_cmd=prepare_update_cmd,
+    )
 
     def excepthook(exc_type, exc_value, exc_traceback):
         if args.verbose:
@@ -619,153 +1607,31 @@ def main():
             logging.error(
                 "Unhandled exception {}: {}".format(exc_type.__name__, str(exc_value))
             )
-        if issues:
+        if workflow.journal is not None:
+            if any(issue.id is not None for issue in workflow.issues):
+                print(
+                    '\nError happened, but some issues have already been created. To continue from where it stopped (issues which have already been updated will be skipped), fix the problem, then execute:\n'
+                )
+                print(prepare_resume_cmd(workflow.journal.path))
+                print('\nFAIL')
+        elif workflow.issues:
             print(
                 '\nError happened, but some issues have already been created. To update existing issues, edit templates/vars, then execute:\n'
             )
-            print(prepare_future_update_cmd(issues, common_vars, args.update))
+            print(workflow.future_update_cmd())
             print('\nFAIL')
+        if args.timings:
+            timings.write(args.timings)
 
     sys.excepthook = excepthook
 
-    if args.vars:
-        with open(
-            os.path.join(args.template_dir, args.vars), 'r', encoding='utf8'
-        ) as f:
-            common_vars = yaml.load(f)
-    else:
-        for common_vars_file in COMMON_VARS_FILES:
-            try:
-                with open(
-                    os.path.join(args.template_dir, common_vars_file),
-                    'r',
-                    encoding='utf8',
-                ) as f:
-                    common_vars = yaml.load(f)
-            except FileNotFoundError:
-                pass
-
-    common_vars = process_vars(common_vars, 'common_vars')
-    mutate_pyfile = os.path.join(args.template_dir, 'mutate.py')
-    if os.path.isfile(mutate_pyfile):
-        spec = importlib.util.spec_from_file_location("mutate_module", mutate_pyfile)
-        mutate_module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(mutate_module)
-        common_vars = mutate_module.mutate(common_vars)
-    logging.debug((f'-- common_vars --\n\n{pretty_dump(common_vars)}'))
-
-    update = {}
-    if args.update:
-        update = json.loads(args.update)
-        common_vars['updating'] = datetime.datetime.timestamp(
-            datetime.datetime.utcnow()
-        )
-
-    global jinja_env_permissive
-    global jinja_env_strict
-    jinja_env_permissive = OurJinjaEnvironment(
-        loader=OurJinjaLoader(args.template_dir),
-        undefined=ChainableDebugUndefined,
-    )
-    jinja_env_strict = OurJinjaEnvironment(
-        loader=OurJinjaLoader(args.template_dir),
-        undefined=StrictUndefined,
-    )
-
-    for filename in natsorted(os.listdir(args.template_dir)):
-        for issue_type_ext, IssueType in ISSUE_TYPES.items():
-            if filename.endswith(issue_type_ext):
-                if IssueType == JiraIssue:
-                    type_specific_params = {'jira': args.jira}
-                elif IssueType == EmailIssue:
-                    type_specific_params = {
-                        'smtp': args.email_smtp,
-                        'user': args.email_user,
-                        'email_from': args.email_from,
-                        'keyring_service': args.email_keyring_service_name,
-                    }
-                with open(
-                    os.path.join(args.template_dir, filename), 'r', encoding='utf8'
-                ) as f:
-                    data = yaml.load(f)
-
-                    if_jinja = data.pop('if', None)
-                    no_update = data.pop('no_update', False)
-                    force_no_update = data.pop('force_no_update', False)
-
-                    foreach = cast(
-                        Sequence[Optional[Any]],
-                        jinja_render_recursive(
-                            jinja_env_strict,
-                            data.pop('foreach', (None,)),
-                            common_vars,
-                            [filename, 'foreach'],
-                        ),
-                    )
-                    foreach_fromvar = data.pop('foreach_fromvar', None)
-                    if foreach_fromvar is not None:
-                        foreach = cast(
-                            Sequence[Optional[Any]], common_vars[foreach_fromvar]
-                        )  # should crash if not exists
-                    foreach_key = data.pop('foreach_key', 'item')
-                    foreach_namevar = data.pop('foreach_namevar', None)
-                    for i, item in enumerate(foreach):
-                        basename = filename.replace(issue_type_ext, '')
-
-                        if foreach_namevar is not None:
-                            assert (
-                                item is not None
-                            ), 'Using foreach_namevar but no foreach/foreach_fromvar?'
-                            basename_key = item[foreach_namevar]
-                        else:
-                            basename_key = item
-
-                        name = basename
-                        if basename_key is not None:
-                            name += f'_{basename_key}'
-
-                        additional_vars = {}
-                        if item is not None:
-                            additional_vars[foreach_key] = item
-
-                        if if_jinja is not None:
-                            computed = jinja_render_recursive(
-                                jinja_env_strict,
-                                if_jinja,
-                                dict(**common_vars, **additional_vars),
-                                [filename, 'if'],
-                            )
-                            if computed.lower() in ('false', 'no', ''):
-                                continue
-
-                        issues.append(
-                            IssueType(
-                                name=name,
-                                common_vars=common_vars,
-                                additional_vars=additional_vars,
-                                data=data.copy(),
-                                id=update[name] if name in update else None,
-                                is_dryrun=args.dry_run,
-                                no_update=(
-                                    force_no_update
-                                    if force_no_update
-                                    else (no_update if name in update else False)
-                                ),
-                                updating=name in update,
-                                fromfile=filename,
-                                basename=basename,
-                                basename_key=basename_key,
-                                **type_specific_params,
-                            )
-                        )
-
-    future_cmd_short = prepare_future_update_cmd(issues, common_vars, args.update)
-
-    for issue in issues:
-        issue.update()
+    result = workflow.execute()
+    engine.close()
+    if args.timings:
+        timings.write(args.timings)
 
     print('\nTo update existing issues, edit templates/vars, then execute:\n')
-    print(future_cmd_short)
+    print(result.update_cmd)
     print('\nSUCCESS')
 
 
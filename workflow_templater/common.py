@@ -1,12 +1,24 @@
+import threading
 from io import StringIO
 
-import ruamel.yaml
+# created on first use: ruamel.yaml is not needed unless something is printed
+yaml = None
+yaml_lock = threading.Lock()
+
+
+def get_yaml():
+    global yaml
+    if yaml is None:
+        import ruamel.yaml
+
+        yaml = ruamel.yaml.YAML(typ='rt')
+        yaml.indent(mapping=2, sequence=2, offset=0)
+        yaml.width = 99999
+    return yaml
 
 
 def pretty_dump(obj):
-    yaml = ruamel.yaml.YAML(typ='rt')
-    yaml.indent(mapping=2, sequence=2, offset=0)
-    yaml.width = 99999
+    from ruamel.yaml.scalarstring import LiteralScalarString
 
     def make_good_strings(obj):
         if type(obj) == list:
@@ -23,7 +35,7 @@ def pretty_dump(obj):
             )
         elif type(obj) == str:
             if obj.count('\n') > 0:
-                return ruamel.yaml.scalarstring.LiteralScalarString(
+                return LiteralScalarString(
                     '\n'.join(map(lambda x: x.rstrip(), obj.splitlines()))
                 )
             else:
@@ -31,6 +43,16 @@ def pretty_dump(obj):
         else:
             return obj
 
-    with StringIO() as strio:
-        yaml.dump(make_good_strings(obj), stream=strio)
+    with StringIO() as strio, yaml_lock:
+        get_yaml().dump(make_good_strings(obj), stream=strio)
         return strio.getvalue()
+
+
+class LazyDump:
+    '''pretty_dump() for logging arguments: done only if the message is actually printed'''
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pretty_dump(self.obj)
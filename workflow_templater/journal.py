@@ -0,0 +1,106 @@
+'''
+Append-only journal of the run (a new run replaces the journal of the previous
+one in the same file). Ids of issues and finished updates are written (and
+fsync'ed) as soon as they are known so that interrupted run can be continued
+with --resume. JSON lines:
+
+    {"updating": <value of "updating" variable or null>}  (first line)
+    {"ids": {<name>: <issue key or Message-ID>, ...}}  (existing issues to update, see --update)
+    {"name": <name>, "id": <issue key or Message-ID>, "updating": <bool>}
+    {"updated": <name>}
+
+'''
+
+import json
+import os
+import threading
+
+
+def is_journal_header(line):
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError:
+        return False
+    return isinstance(record, dict) and list(record) == ['updating']
+
+
+class Journal:
+    '''
+    resume: continue the journal of the interrupted run, otherwise the journal
+    of a previous run in the same file is replaced
+    '''
+
+    def __init__(self, path, updating=None, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a+', encoding='utf8')
+        if self.file.tell() == 0:
+            self.write({'updating': updating})
+        else:
+            end = self.file.tell()
+            self.file.seek(0)
+            if not is_journal_header(self.file.readline()):
+                self.file.close()
+                raise Exception(
+                    f'{path} already exists and is not a journal of workflow-templater'
+                )
+            if not resume:
+                # records of the previous run would be taken for the ones of this run
+                self.file.seek(0)
+                self.file.truncate()
+                self.write({'updating': updating})
+                return
+            self.file.seek(end - 1)
+            if self.file.read(1) != '\n':
+                # the last line is incomplete, the process has been killed while writing it
+                self.write({})
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def known(self, ids):
+        self.write({'ids': ids})
+
+    def created(self, name, id, updating):
+        self.write({'name': name, 'id': id, 'updating': updating})
+
+    def updated(self, name):
+        self.write({'updated': name})
+
+    def close(self, remove=False):
+        with self.lock:
+            self.file.close()
+            if remove:
+                os.remove(self.path)
+
+
+class ResumedRun:
+    def __init__(self, path):
+        self.updating = None
+        self.ids = {}
+        self.updating_names = set()
+        self.updated = set()
+        with open(path, 'r', encoding='utf8') as f:
+            for number, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be incomplete if the process has been killed
+                    continue
+                if number == 0:
+                    self.updating = record['updating']
+                elif 'updated' in record:
+                    self.updated.add(record['updated'])
+                elif 'ids' in record:
+                    self.ids.update(record['ids'])
+                    self.updating_names.update(record['ids'])
+                else:
+                    self.ids[record['name']] = record['id']
+                    if record['updating']:
+                        self.updating_names.add(record['name'])
+                    else:
+                        self.updating_names.discard(record['name'])
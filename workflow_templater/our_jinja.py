@@ -2,39 +2,80 @@
 Changes over regular jinja2:
 * support for arbitrary relative imports, example:
     {% include '../common/cluster_update.j2' %}
+* loader reads every template file only once (until reset() which is called
+  before each run), so it may be shared by several environments
+* OurBytecodeCache: persistent bytecode cache keyed by real path of the
+  template file (relative includes may reach it by different names)
 * implemented filters
   * quote: escape string for POSIX shell
 * implemented tests:
   * contains: checks if iterable contains an element;
     similar to built-in "in" but works vice-versa
+* render_template: renders template with any mapping (for example, ChainMap)
+  as variables without copying it
+* compile_template: bounded cache of templates compiled from strings,
+  shared by all environments in the process
+* analyze_template, referenced_variables: static analysis of variables used
+  by a template (including the templates it includes or imports)
 '''
 
 import os
+from collections import ChainMap
+from functools import lru_cache
 from shlex import quote
+from typing import NamedTuple
 
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    TemplateNotFound,
+    meta,
+)
 
 
 class OurJinjaLoader(FileSystemLoader):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # template files don't change during a run
+        self.sources = {}
+        self.generation = 0
+
+    def reset(self):
+        '''Forget sources read so far, templates loaded before become outdated'''
+        self.sources = {}
+        self.generation += 1
+
     def get_source(self, environment, template):
+        sources = self.sources
+        if template not in sources:
+            sources[template] = self.read_source(template)
+        contents, filename = sources[template]
+        generation = self.generation
+        return contents, filename, lambda: self.generation == generation
+
+    def read_source(self, template):
         for searchpath in self.searchpath:
             filename = os.path.join(searchpath, template)
             try:
                 with open(filename, 'r', encoding='utf-8') as f:
-                    contents = f.read()
+                    return f.read(), filename
             except FileNotFoundError:
                 continue
+        raise TemplateNotFound(template)
 
-            mtime = os.path.getmtime(filename)
 
-            def uptodate():
-                try:
-                    return os.path.getmtime(filename) == mtime
-                except OSError:
-                    return False
+class OurBytecodeCache(FileSystemBytecodeCache):
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory)
 
-            return contents, filename, uptodate
-        raise TemplateNotFound(template)
+    def get_cache_key(self, name, filename=None):
+        # name is still a part of the key: compiled code remembers it and
+        # it is used to resolve relative includes
+        if filename is not None:
+            filename = os.path.realpath(filename)
+        return super().get_cache_key(name, filename)
 
 
 class OurJinjaEnvironment(Environment):
@@ -45,3 +86,73 @@ class OurJinjaEnvironment(Environment):
 
     def join_path(self, template, parent):
         return os.path.join(os.path.dirname(parent), template)
+
+
+def render_template(template, variables):
+    '''Same as template.render(variables) but doesn't copy variables into a new dict'''
+    context = template.new_context(ChainMap(variables, template.globals), shared=True)
+    try:
+        return template.environment.concat(template.root_render_func(context))
+    except Exception:
+        template.environment.handle_exception()
+
+
+TEMPLATE_CACHE_SIZE = 8192
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(environment, source):
+    return environment.from_string(source)
+
+
+class TemplateReferences(NamedTuple):
+    variables: frozenset
+    templates: frozenset
+
+
+def analyze_template(environment, source):
+    '''
+    Returns TemplateReferences: names of variables which template may read and
+    names of templates which it includes or imports (recursively),
+    or None if it can't be determined statically (for example, include of a computed name)
+    '''
+    # included templates may change after loader.reset()
+    generation = getattr(environment.loader, 'generation', None)
+    return _analyze_template_cached(environment, source, generation)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _analyze_template_cached(environment, source, generation):
+    variables = set()
+    templates = set()
+    if not _analyze_template(environment, source, None, variables, templates):
+        return None
+    return TemplateReferences(frozenset(variables), frozenset(templates))
+
+
+def _analyze_template(environment, source, name, variables, templates):
+    ast = environment.parse(source)
+    variables.update(meta.find_undeclared_variables(ast))
+    for template in meta.find_referenced_templates(ast):
+        if template is None:
+            return False
+        if name is not None:
+            template = environment.join_path(template, name)
+        if template in templates:
+            continue
+        templates.add(template)
+        if environment.loader is None:
+            return False
+        try:
+            included, _, _ = environment.loader.get_source(environment, template)
+        except TemplateNotFound:
+            return False
+        if not _analyze_template(environment, included, template, variables, templates):
+            return False
+    return True
+
+
+def referenced_variables(environment, source):
+    '''Names of variables which template may read, None if unknown'''
+    references = analyze_template(environment, source)
+    return None if references is None else references.variables
@@ -0,0 +1,170 @@
+'''
+--profile: runs workflow-templater under cProfile (cpu) or tracemalloc (memory).
+
+cpu writes pstats file, see it with python -m pstats FILE or snakeviz.
+
+memory writes text report of memory allocated at the peak of the run: totals
+for each module of workflow-templater (and each function in it, e.g.
+WorkflowRun.expand_issues which expands foreach) which allocated it directly
+or by calling something else (jinja, ruamel.yaml, ...), then top allocation
+sites by line.
+
+Tracing with deep tracebacks is slow (16 frames slow the run down dozens of
+times), if allocations are attributed to <other> because our frame is deeper,
+start python with -X tracemalloc=N or PYTHONTRACEMALLOC=N with bigger N.
+'''
+
+import ast
+import logging
+import os
+import threading
+import tracemalloc
+from functools import lru_cache
+
+DEFAULT_OUTPUT = {
+    'cpu': 'workflow-templater.pstats',
+    'memory': 'workflow-templater-memory.txt',
+}
+
+OUR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# tracemalloc stores this many frames of each allocation: usually enough to
+# find our function under jinja and ruamel.yaml internals
+TRACEBACK_FRAMES = 16
+
+
+def run(mode, output, func):
+    output = output or DEFAULT_OUTPUT[mode]
+    if mode == 'cpu':
+        return run_cpu(output, func)
+    return run_memory(output, func)
+
+
+def run_cpu(output, func):
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(output)
+        logging.info(
+            'CPU profile written to %s, see python -m pstats %s', output, output
+        )
+
+
+class PeakSnapshot:
+    '''
+    Snapshot of traced memory taken when it has grown noticeably since the
+    previous one: memory of issues, templates and vars is released at the end
+    of the run, so snapshot taken after it would be useless
+    '''
+
+    GROWTH = 1.1
+    INTERVAL = 0.05
+
+    def __init__(self):
+        self.snapshot = None
+        self.size = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+
+    def take(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.size * self.GROWTH:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.size = current
+
+    def watch(self):
+        while not self.stopped.wait(self.INTERVAL):
+            self.take()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.take()
+
+
+def run_memory(output, func):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEBACK_FRAMES)
+    try:
+        with PeakSnapshot() as peak:
+            return func()
+    finally:
+        _, peak_size = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with open(output, 'w', encoding='utf8') as f:
+            write_memory_report(f, peak.snapshot, peak_size)
+        logging.info('memory profile written to %s', output)
+
+
+@lru_cache(maxsize=None)
+def functions_by_line(filename):
+    '''Returns [(first line, last line, qualified name)] of functions defined in filename'''
+    with open(filename, encoding='utf8') as f:
+        tree = ast.parse(f.read(), filename)
+    result = []
+
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                name = f'{prefix}{child.name}'
+                if not isinstance(child, ast.ClassDef):
+                    result.append((child.lineno, child.end_lineno, name))
+                visit(child, f'{name}.')
+
+    visit(tree, '')
+    # innermost function is the last one which contains the line
+    return sorted(result)
+
+
+def our_location(traceback):
+    '''Returns (module, function) of the most recent frame of workflow-templater, None if there is none'''
+    for frame in reversed(traceback):
+        if os.path.dirname(frame.filename) != OUR_DIR:
+            continue
+        module = os.path.splitext(os.path.basename(frame.filename))[0]
+        if module == '__init__':
+            module = 'workflow_templater'
+        function = '<module>'
+        for first, last, name in functions_by_line(frame.filename):
+            if first > frame.lineno:
+                break
+            if frame.lineno <= last:
+                function = name
+        return module, function
+    return None
+
+
+def write_memory_report(f, snapshot, peak_size, top=30):
+    MiB = 1024 * 1024
+    f.write(f'peak traced memory: {peak_size / MiB:.1f} MiB\n')
+    if snapshot is None:
+        return
+    modules = {}
+    functions = {}
+    for trace in snapshot.traces:
+        module, function = our_location(trace.traceback) or ('<other>', '')
+        modules[module] = modules.get(module, 0) + trace.size
+        key = f'{module}.{function}' if function else module
+        functions[key] = functions.get(key, 0) + trace.size
+    total = sum(modules.values())
+    f.write(f'traced memory in the snapshot: {total / MiB:.1f} MiB\n')
+
+    for title, sizes in (('module', modules), ('function', functions)):
+        f.write(f'\nby {title} of workflow-templater:\n')
+        ranked = sorted(sizes.items(), key=lambda item: item[1], reverse=True)
+        for name, size in ranked[:top]:
+            f.write(f'  {size / MiB:10.2f} MiB {size / total:6.1%}  {name}\n')
+
+    f.write(f'\ntop {top} allocation sites:\n')
+    for stat in snapshot.statistics('lineno')[:top]:
+        frame = stat.traceback[0]
+        f.write(
+            f'  {stat.size / MiB:10.2f} MiB {stat.count:9} blocks  {frame.filename}:{frame.lineno}\n'
+        )
@@ -0,0 +1,197 @@
+'''
+Client-side rate limiting for jira requests: a token bucket per jira instance.
+It doesn't limit anything until the server complains; after 429/503 responses
+the rate is set below the rate the server has accepted during the last
+WINDOW seconds, requests are paused for Retry-After and retried, and while
+requests succeed the rate grows back by a share of the accepted rate every
+second. If the server describes its own limits in X-RateLimit-* headers (Jira
+Cloud), the bucket follows them.
+'''
+
+import datetime
+import email.utils
+import logging
+import threading
+import time
+from collections import deque
+from urllib.error import HTTPError
+
+RETRY_STATUSES = (429, 503)
+MAX_RETRIES = 8
+MIN_RATE = 0.2  # requests per second
+# of the accepted rate, which is measured without the throttled requests
+DECREASE = 0.9
+# 429s soon after the rate has been decreased are caused by the same overload
+DECREASE_INTERVAL = 1.0  # seconds
+INCREASE = 2.0  # requests per second every second, at least
+INCREASE_SHARE = 0.5  # of the accepted rate every second
+# the rate doesn't grow far above what the server has actually accepted
+MAX_OVERSHOOT = 2.0
+WINDOW = 2.0  # seconds
+MIN_SPAN = 0.1  # seconds
+MAX_BACKOFF = 60  # seconds
+
+
+def parse_retry_after(value):
+    '''Retry-After is either seconds or HTTP-date, returns seconds'''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(
+            0.0,
+            (
+                email.utils.parsedate_to_datetime(value)
+                - datetime.datetime.now(datetime.timezone.utc)
+            ).total_seconds(),
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_reset(value):
+    '''X-RateLimit-Reset is ISO 8601 timestamp, returns seconds from now'''
+    try:
+        reset = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if reset.tzinfo is None:
+        reset = reset.replace(tzinfo=datetime.timezone.utc)
+    return max(
+        0.0, (reset - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    )
+
+
+class RateLimiter:
+    def __init__(self):
+        self.rate = None  # requests per second, None means no limit
+        self.capacity = 1.0
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.throttled_in_a_row = 0
+        self.decreased = float('-inf')
+        # completion times of successful requests during the last WINDOW seconds
+        self.recent = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.paused_until - now
+                if delay <= 0:
+                    if self.rate is not None:
+                        self.tokens = min(
+                            self.capacity,
+                            self.tokens + (now - self.updated) * self.rate,
+                        )
+                        self.updated = now
+                    if self.rate is None or self.tokens >= 1:
+                        if self.rate is not None:
+                            self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def observed_rate(self, now):
+        '''How many requests per second the server has accepted during the last WINDOW seconds'''
+        while self.recent and self.recent[0] < now - WINDOW:
+            self.recent.popleft()
+        if not self.recent:
+            return MIN_RATE
+        return len(self.recent) / max(MIN_SPAN, now - self.recent[0])
+
+    def follow_headers(self, headers, now):
+        fill_rate = headers.get('X-RateLimit-FillRate')
+        interval = headers.get('X-RateLimit-Interval-Seconds')
+        limit = headers.get('X-RateLimit-Limit')
+        remaining = headers.get('X-RateLimit-Remaining')
+        try:
+            if fill_rate is not None:
+                self.rate = max(MIN_RATE, float(fill_rate) / float(interval or 1))
+            if limit is not None:
+                self.capacity = max(1.0, float(limit))
+            if remaining is not None:
+                self.tokens = min(self.tokens, float(remaining))
+                if float(remaining) < 1:
+                    reset = parse_reset(headers.get('X-RateLimit-Reset'))
+                    if reset is not None:
+                        self.paused_until = max(self.paused_until, now + reset)
+        except ValueError:
+            pass
+
+    def throttled(self, headers):
+        '''Returns for how long requests are paused'''
+        with self.lock:
+            now = time.monotonic()
+            self.throttled_in_a_row += 1
+            if now >= self.paused_until and now - self.decreased >= DECREASE_INTERVAL:
+                # requests which have been sent before the pause don't slow down further
+                accepted = self.observed_rate(now)
+                if self.rate is not None:
+                    accepted = min(accepted, self.rate)
+                self.rate = max(MIN_RATE, accepted * DECREASE)
+                self.decreased = now
+            self.capacity = 1.0
+            self.tokens = 0.0
+            self.updated = now
+            self.follow_headers(headers, now)
+            delay = parse_retry_after(headers.get('Retry-After'))
+            if delay is None:
+                delay = min(MAX_BACKOFF, 2 ** (self.throttled_in_a_row - 1))
+            self.paused_until = max(self.paused_until, now + delay)
+            return self.paused_until - now
+
+    def succeeded(self, headers):
+        with self.lock:
+            now = time.monotonic()
+            self.throttled_in_a_row = 0
+            self.recent.append(now)
+            if self.rate is not None:
+                accepted = self.observed_rate(now)
+                # each of rate requests/s adds its share so that the rate grows
+                # by INCREASE_SHARE of the accepted rate every second
+                self.rate += max(INCREASE, accepted * INCREASE_SHARE) / self.rate
+                self.rate = min(self.rate, max(INCREASE, accepted * MAX_OVERSHOOT))
+            self.follow_headers(headers, now)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(jira_base):
+    with _limiters_lock:
+        if jira_base not in _limiters:
+            _limiters[jira_base] = RateLimiter()
+        return _limiters[jira_base]
+
+
+def call_rate_limited(limiter, function, *args):
+    '''
+    function returns response or raises HTTPError, 429 and 503 are retried,
+    number of retries is saved as "retries" attribute of the response or error
+    '''
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            response = function(*args)
+        except HTTPError as e:
+            if e.code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                e.retries = attempt
+                raise
+            delay = limiter.throttled(e.headers)
+            logging.info(
+                'got %s, slowing down to %.1f requests/s, retrying in %.1fs',
+                e.code,
+                limiter.rate,
+                delay,
+            )
+            continue
+        limiter.succeeded(response.headers)
+        response.retries = attempt
+        return response
@@ -0,0 +1,317 @@
+'''
+Creates issues concurrently. Issue is created only after all previously defined
+issues whose issuekey_ variables it references in its creation payload, so the
+result is the same as if issues were created one by one in order.
+Issues of a type which supports it (send_create_batch) and which are ready
+at the same time may be created in batches.
+
+Updates are rendered in order and sent in parallel, log messages of each
+issue are printed together once it is updated.
+
+StreamingPipeline creates and updates issues in chunks, so only lightweight
+IssueRef of processed issues stay in memory.
+'''
+
+import contextvars
+import heapq
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from itertools import chain
+from typing import Any, NamedTuple
+
+try:
+    from .timings import measure
+except ImportError:
+    # preserve ability to launch __main__.py directly
+    from timings import measure
+
+
+def references_issuekeys(referenced):
+    return referenced is None or any(
+        name.startswith('issuekey_') for name in referenced
+    )
+
+
+def provided_variables(issue):
+    names = [f'issuekey_{ issue.name }']
+    if issue.basename and issue.basename != issue.name:
+        names.append(f'issuekey_{ issue.basename }')
+    return names
+
+
+class CreationScheduler:
+    def __init__(self, concurrency=1, batch_size=0):
+        self.concurrency = max(1, concurrency)
+        self.batch_size = batch_size
+        self.pending = []
+
+    def add(self, issue):
+        self.pending.append(issue)
+
+    def run(self):
+        '''Creates all issues added so far'''
+        issues, self.pending = self.pending, []
+        if self.concurrency == 1 and self.batch_size <= 1:
+            for issue in issues:
+                issue.create()
+            return
+
+        providers = defaultdict(list)
+        waiting_for = []
+        dependents = defaultdict(list)
+        for index, issue in enumerate(issues):
+            referenced = issue.creation_references()
+            if referenced is None:
+                dependencies = set(range(index))
+            else:
+                dependencies = {
+                    dependency
+                    for name in referenced
+                    if name != 'issuekey_self'
+                    for dependency in providers.get(name, ())
+                }
+            waiting_for.append(len(dependencies))
+            for dependency in dependencies:
+                dependents[dependency].append(index)
+            for name in provided_variables(issue):
+                providers[name].append(index)
+
+        # earlier issues first, just like in sequential mode
+        ready = [index for index, count in enumerate(waiting_for) if count == 0]
+        heapq.heapify(ready)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                while ready or running:
+                    while ready and len(running) < self.concurrency:
+                        batch = self.take_batch(issues, ready)
+                        running[self.submit(executor, issues, batch)] = batch
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        batch = running.pop(future)
+                        self.finish(issues, batch, future)
+                        for index in batch:
+                            for dependent in dependents[index]:
+                                waiting_for[dependent] -= 1
+                                if waiting_for[dependent] == 0:
+                                    heapq.heappush(ready, dependent)
+            finally:
+                # remember keys of issues that managed to get created before the failure
+                for future, batch in running.items():
+                    try:
+                        self.finish(issues, batch, future)
+                    except Exception:
+                        pass
+
+    def take_batch(self, issues, ready):
+        first = heapq.heappop(ready)
+        batch = [first]
+        if self.batch_size > 1 and issues[first].send_create_batch is not None:
+            skipped = []
+            while ready and len(batch) < self.batch_size:
+                index = heapq.heappop(ready)
+                if type(issues[index]) is type(issues[first]):
+                    batch.append(index)
+                else:
+                    skipped.append(index)
+            for index in skipped:
+                heapq.heappush(ready, index)
+        return batch
+
+    @staticmethod
+    def submit(executor, issues, batch):
+        # rendering reads common_vars, so it's done in this thread only
+        payloads = []
+        for index in batch:
+            issue = issues[index]
+            with measure(
+                'render', template=issue.fromfile, stage='create', issue=issue.name
+            ):
+                payloads.append(issue.render_create())
+        # log records and timings of the worker belong to the same run
+        # (see server.current_report, timings.current_timings)
+        context = contextvars.copy_context()
+        if len(batch) == 1:
+            return executor.submit(
+                context.run, issues[batch[0]].send_create, payloads[0]
+            )
+        return executor.submit(
+            context.run,
+            issues[batch[0]].send_create_batch,
+            [issues[index] for index in batch],
+            payloads,
+        )
+
+    @staticmethod
+    def finish(issues, batch, future):
+        results = future.result() if len(batch) > 1 else [future.result()]
+        failed = []
+        for index, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logging.error(
+                    'failed to create issue for %s: %s', issues[index].name, result
+                )
+                failed.append(issues[index].name)
+            else:
+                issues[index].id = result
+        if failed:
+            raise Exception(f'failed to create issues: {", ".join(failed)}')
+
+
+class GroupedLogging(logging.Filter):
+    '''Holds back records logged from inside collect() to emit them together later'''
+
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+
+    def filter(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    def collect(self, function, *args):
+        '''Returns records logged by function and exception raised by it, if any'''
+        self.local.records = records = []
+        try:
+            function(*args)
+            return records, None
+        except Exception as e:
+            return records, e
+        finally:
+            self.local.records = None
+
+
+def update_issues(issues, concurrency=1):
+    if concurrency <= 1:
+        for issue in issues:
+            issue.update()
+        return
+
+    logger = logging.getLogger()
+    grouped = GroupedLogging()
+    logger.addFilter(grouped)
+    running = set()
+
+    def finish(future):
+        records, error = future.result()
+        for record in records:
+            logger.handle(record)
+        if error is not None:
+            raise error
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            try:
+                for issue in issues:
+                    if not issue.needs_update():
+                        continue
+                    if len(running) >= concurrency * 2:
+                        done, running = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            finish(future)
+                    # rendering reads common_vars, so it's done in this thread only
+                    with measure(
+                        'render',
+                        template=issue.fromfile,
+                        stage='update',
+                        issue=issue.name,
+                    ):
+                        payload = issue.render_update()
+                    running.add(
+                        executor.submit(
+                            contextvars.copy_context().run,
+                            grouped.collect,
+                            issue.finish_update,
+                            payload,
+                        )
+                    )
+                for future in as_completed(list(running)):
+                    running.discard(future)
+                    finish(future)
+            finally:
+                # let already started updates print their logs
+                for future in as_completed(running):
+                    try:
+                        finish(future)
+                    except Exception as e:
+                        logging.error('%s', e)
+    finally:
+        logger.removeFilter(grouped)
+
+
+class IssueRef(NamedTuple):
+    name: str
+    id: Any
+
+
+class StreamingPipeline:
+    def __init__(self, scheduler, chunk_size, concurrency, common_vars):
+        self.scheduler = scheduler
+        self.chunk_size = max(1, chunk_size)
+        self.concurrency = concurrency
+        self.common_vars = common_vars
+        self.chunk = []
+        self.deferred = []
+        self.refs = []
+        # basenames of templates all issues of which have been added
+        self.expanded_basenames = set()
+        # ... and created, their issuekey_<basename> dicts are complete
+        self.complete_basenames = set()
+
+    def add(self, issue):
+        self.chunk.append(issue)
+        if issue.id is None:
+            self.scheduler.add(issue)
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        '''Creates issues added so far and updates the ones which can be updated already'''
+        chunk, self.chunk = self.chunk, []
+        try:
+            self.scheduler.run()
+        finally:
+            self.refs.extend(
+                IssueRef(issue.name, issue.id)
+                for issue in chunk
+                if issue.id is not None
+            )
+        self.complete_basenames |= self.expanded_basenames
+        ready = []
+        deferred, self.deferred = self.deferred, []
+        for issue in chain(deferred, chunk):
+            (ready if self.can_update(issue) else self.deferred).append(issue)
+        update_issues(ready, self.concurrency)
+
+    def expanded(self, basename):
+        '''All issues of template basename have been added'''
+        self.expanded_basenames.add(basename)
+
+    def can_update(self, issue):
+        referenced = issue.update_references()
+        if referenced is None:
+            return False
+        for name in referenced:
+            if name == 'update_issues_cmd':
+                return False
+            if name.startswith('issuekey_') and name != 'issuekey_self':
+                value = self.common_vars.get(name)
+                if value is None:
+                    return False
+                # issuekey_<basename> of foreach template (dict) is complete
+                # only after all its issues have been created
+                if (
+                    isinstance(value, dict)
+                    and name[len('issuekey_') :] not in self.complete_basenames
+                ):
+                    return False
+        return True
+
+    def update_deferred(self):
+        deferred, self.deferred = self.deferred, []
+        update_issues(deferred, self.concurrency)
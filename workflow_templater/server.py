@@ -0,0 +1,178 @@
+'''
+workflow-templater serve: HTTP server which runs template dirs on request
+with one WorkflowEngine, so parsed files, compiled templates, credentials and
+connections stay warm between runs. Requests are handled concurrently.
+
+    POST /run
+    Authorization: Bearer <token>
+    {"template_dir": "...", "vars": {...}, "update": {...}, "dry_run": true}
+
+Optional fields: vars (overrides), vars_file, update, resume, journal,
+dry_run, see WorkflowRun. Response:
+
+    {"ids": {<issue name>: <key>}, "update": <value of "update" to update
+     these issues later>, "report": <log of the run>}
+
+On failure (HTTP 500) "error" is added, "ids" are issues created so far and
+"resume" is the journal to pass as "resume" to continue the run.
+
+Runs act with credentials of the user running the server and execute
+mutate.py of template dirs, so requests without the token (written to
+--token-file, readable only by this user) get 401, template_dir must be
+inside one of --root dirs, vars_file inside template_dir, journal and resume
+inside journal_dir of the engine (403 otherwise). Variables which have to be
+entered interactively (_workflow_templater_ask:) must be passed in vars.
+'''
+
+import hmac
+import json
+import logging
+import os
+import secrets
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RUN_OPTIONS = frozenset(('vars', 'update', 'vars_file', 'resume', 'journal', 'dry_run'))
+
+# list of log lines of the run handled by the current thread
+current_report = ContextVar('current_report', default=None)
+
+
+class ReportHandler(logging.Handler):
+    def emit(self, record):
+        report = current_report.get()
+        if report is not None:
+            report.append(self.format(record))
+
+
+def is_inside(path, directory):
+    path, directory = os.path.realpath(path), os.path.realpath(directory)
+    return os.path.commonpath([path, directory]) == directory
+
+
+def check_paths(request, template_dir, roots, journal_dir):
+    '''Raises PermissionError if paths of the request are outside of allowed dirs'''
+    if not any(is_inside(template_dir, root) for root in roots):
+        raise PermissionError(f'{template_dir} is outside of --root dirs')
+    vars_file = request.get('vars_file')
+    if vars_file and not is_inside(os.path.join(template_dir, vars_file), template_dir):
+        raise PermissionError(f'vars_file {vars_file} is outside of template_dir')
+    for option in ('journal', 'resume'):
+        path = request.get(option)
+        if path and (journal_dir is None or not is_inside(path, journal_dir)):
+            raise PermissionError(f'{option} {path} is outside of journal dir')
+
+
+def write_token(path):
+    '''Writes a new token to path readable only by the current user, returns it'''
+    token = secrets.token_urlsafe(32)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # O_CREAT mode doesn't apply to already existing file
+    os.chmod(path, 0o600)
+    with open(fd, 'w', encoding='utf8') as f:
+        f.write(token)
+    return token
+
+
+class RunRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, response):
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        authorization = self.headers.get('Authorization', '').encode(errors='replace')
+        if not hmac.compare_digest(
+            authorization, f'Bearer {self.server.token}'.encode()
+        ):
+            self.send_json(401, {'error': 'missing or wrong token, see --token-file'})
+            return
+        if self.path != '/run':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            request = json.loads(
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            )
+            template_dir = request.pop('template_dir')
+            unknown = set(request) - RUN_OPTIONS
+            if unknown:
+                raise ValueError(f'unknown fields: {", ".join(sorted(unknown))}')
+            check_paths(
+                request,
+                template_dir,
+                self.server.roots,
+                self.server.engine.journal_dir,
+            )
+        except PermissionError as e:
+            self.send_json(403, {'error': str(e)})
+            return
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send_json(400, {'error': f'bad request: {e!r}'})
+            return
+
+        report = []
+        token = current_report.set(report)
+        try:
+            workflow = self.server.engine.workflow(
+                template_dir, interactive=False, **request
+            )
+            try:
+                result = workflow.execute()
+            except Exception as e:
+                logging.error('Unhandled exception %s: %s', type(e).__name__, e)
+                logging.debug('traceback', exc_info=True)
+                response = {
+                    'error': f'{type(e).__name__}: {e}',
+                    'ids': {
+                        issue.name: issue.id
+                        for issue in workflow.issues
+                        if issue.id is not None
+                    },
+                    'report': '\n'.join(report),
+                }
+                if workflow.journal is not None and response['ids']:
+                    response['resume'] = workflow.journal.path
+                self.send_json(500, response)
+            else:
+                self.send_json(
+                    200,
+                    {
+                        'ids': result.ids,
+                        'update': result.update_cmd,
+                        'report': '\n'.join(report),
+                    },
+                )
+        finally:
+            current_report.reset(token)
+
+    def log_message(self, format, *args):
+        logging.debug('%s %s', self.address_string(), format % args)
+
+
+def serve(engine, address, token_file, roots):
+    '''Serves until interrupted, address is (host, port)'''
+    server = ThreadingHTTPServer(address, RunRequestHandler)
+    server.engine = engine
+    server.token = write_token(token_file)
+    server.roots = roots
+    handler = ReportHandler()
+    handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    logging.getLogger().addHandler(handler)
+    logging.info(
+        'listening on http://%s:%s/, token is in %s',
+        *server.server_address[:2],
+        token_file,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.getLogger().removeHandler(handler)
+        server.server_close()
+        engine.close()
@@ -0,0 +1,101 @@
+'''
+SMTP connection shared by all emails of the run (or of all runs of
+WorkflowEngine): connection, STARTTLS and login happen once, messages are
+sent over the same connection which is re-established if the server drops it.
+
+Usage:
+
+    sessions = SMTPSessions()
+    sessions.get('smtp.example.com:587', user, keyring_service).send_message(msg)
+    ...
+    sessions.close()
+
+'''
+
+import logging
+import smtplib
+import threading
+
+try:
+    from .urlopen_jira import get_password
+except ImportError:
+    # preserve ability to launch __main__.py directly
+    from urlopen_jira import get_password
+
+
+class SMTPSession:
+    def __init__(self, smtp, user, keyring_service, starttls=True):
+        self.host, port = smtp.split(':')
+        self.port = int(port)
+        self.user = user
+        self.keyring_service = keyring_service
+        self.starttls = starttls
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        connection = smtplib.SMTP(self.host, self.port)
+        if self.starttls:
+            connection.starttls()
+        # local relays accept mail without authentication
+        if self.user:
+            # TODO: handle bad password here
+            logging.debug(
+                connection.login(
+                    self.user, get_password(self.keyring_service, self.user)
+                )
+            )
+        self.connection = connection
+
+    def send_message(self, msg):
+        with self.lock:
+            reconnected = False
+            while True:
+                if self.connection is None:
+                    self.connect()
+                    reconnected = True
+                try:
+                    return self.connection.send_message(msg)
+                except (
+                    smtplib.SMTPServerDisconnected,
+                    smtplib.SMTPResponseException,
+                ) as e:
+                    # 421: server is closing the connection (idle timeout, too many messages, etc)
+                    if (
+                        isinstance(e, smtplib.SMTPResponseException)
+                        and e.smtp_code != 421
+                    ):
+                        raise
+                    self.close()
+                    if reconnected:
+                        raise
+                    logging.info('SMTP connection has been closed, reconnecting...')
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except smtplib.SMTPException:
+                pass
+            self.connection = None
+
+
+class SMTPSessions:
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, smtp, user, keyring_service, starttls=True):
+        with self.lock:
+            if (smtp, user) not in self.sessions:
+                self.sessions[(smtp, user)] = SMTPSession(
+                    smtp, user, keyring_service, starttls
+                )
+            return self.sessions[(smtp, user)]
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                with session.lock:
+                    session.close()
+            self.sessions.clear()
@@ -0,0 +1,72 @@
+'''
+Remembers hashes of what has been sent for each issue (jira issue key or email
+Message-ID) so that identical updates can be skipped on the next run.
+Kinds of hashes:
+* payload: rendered payload
+* inputs: templates and values of variables which have been used to render it
+
+Runs of the same templates in other processes or threads (server mode) may
+save the same file: only hashes set by this run are merged into what is there
+at the moment of saving.
+'''
+
+import hashlib
+import json
+import os
+import threading
+
+
+def payload_hash(payload):
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+# runs in different threads of the same process don't read and write files in between
+save_lock = threading.Lock()
+
+
+def read_hashes(path):
+    try:
+        with open(path, 'r', encoding='utf8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def merge(hashes, changes):
+    for kind, scopes in changes.items():
+        for scope, digests in scopes.items():
+            hashes.setdefault(kind, {}).setdefault(scope, {}).update(digests)
+
+
+class PushedState:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # set by this run and not saved yet
+        self.changes = {}
+        self.hashes = read_hashes(path)
+
+    def get(self, kind, scope, key):
+        with self.lock:
+            return self.hashes.get(kind, {}).get(scope, {}).get(key)
+
+    def set(self, kind, scope, key, digest):
+        with self.lock:
+            self.hashes.setdefault(kind, {}).setdefault(scope, {})[key] = digest
+            self.changes.setdefault(kind, {}).setdefault(scope, {})[key] = digest
+
+    def save(self):
+        with self.lock, save_lock:
+            if not self.changes:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            hashes = read_hashes(self.path)
+            merge(hashes, self.changes)
+            tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump(hashes, f)
+            os.replace(tmp_path, self.path)
+            self.hashes = hashes
+            self.changes = {}
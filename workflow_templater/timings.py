@@ -0,0 +1,124 @@
+'''
+Instrumentation for --timings: durations of phases of the run, template
+renders, HTTP requests and emails, written as JSON lines:
+
+    {"type": "run", "version": ..., "start": <unix time>}
+    {"type": "phase", "name": "load vars", "wall": <s>, "cpu": <s>}
+    {"type": "render", "template": "1_main.jira.yaml", "stage": "create", "issue": "1_main", "wall": <s>}
+    {"type": "http", "method": "POST", "url": "rest/api/2/issue/", "status": 201, "retries": 0, "wall": <s>}
+    {"type": "smtp", "issue": "6_email", "wall": <s>}
+    {"type": "summary", "of": "http", "group": "POST", "count": ..., "total": <s>, "p50": <s>, "p95": <s>, "p99": <s>, "max": <s>}
+
+Summaries are written for each type (group null) and for each template
+(render) and method (http). Nothing is measured unless current_timings is set,
+it's inherited by worker threads which run in a copy of the context.
+'''
+
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+current_timings = ContextVar('current_timings', default=None)
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, p):
+    '''Nearest-rank percentile'''
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+class Timings:
+    def __init__(self):
+        self.start = time.time()
+        self.records = []
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def summaries(self):
+        groups = {}
+        for record in self.records:
+            if record['type'] == 'phase':
+                continue
+            groups.setdefault((record['type'], None), []).append(record['wall'])
+            group = record.get('template') or record.get('method')
+            if group is not None:
+                groups.setdefault((record['type'], group), []).append(record['wall'])
+        for (type_, group), values in groups.items():
+            values.sort()
+            summary = {
+                'type': 'summary',
+                'of': type_,
+                'group': group,
+                'count': len(values),
+                'total': sum(values),
+            }
+            for p in PERCENTILES:
+                summary[f'p{p}'] = percentile(values, p)
+            summary['max'] = values[-1]
+            yield summary
+
+    def write(self, path):
+        try:
+            from importlib.metadata import version
+
+            our_version = version('workflow_templater')
+        except Exception:
+            our_version = None
+        with self.lock, open(path, 'w', encoding='utf8') as f:
+            f.write(
+                json.dumps({'type': 'run', 'version': our_version, 'start': self.start})
+                + '\n'
+            )
+            for record in self.records:
+                f.write(json.dumps(record, default=str) + '\n')
+            for summary in self.summaries():
+                f.write(json.dumps(summary) + '\n')
+
+
+def record(type_, **fields):
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add({'type': type_, **fields})
+
+
+@contextmanager
+def measure(type_, **fields):
+    '''Records wall time of the block'''
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add({'type': type_, **fields, 'wall': time.perf_counter() - start})
+
+
+@contextmanager
+def phase(name):
+    '''Records wall time and CPU time (of the whole process) of the block'''
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        timings.add(
+            {
+                'type': 'phase',
+                'name': name,
+                'wall': time.perf_counter() - start,
+                'cpu': time.process_time() - start_cpu,
+            }
+        )
@@ -1,7 +1,11 @@
 '''
-Simple wrapper over urllib.request which handles jira authentication
+Simple wrapper over http.client which handles jira authentication
 and saves credentials (password and cookies) in your OS secret storage.
-Depends on https://pypi.org/project/keyring/
+Connections are kept alive and reused (from any thread) for all requests
+to the same host. If a proxy is configured in the environment, urllib.request
+is used instead. Requests are rate limited when jira asks for it, see rate_limit.
+Depends on https://pypi.org/project/keyring/ (imported only when credentials
+are needed: it's slow to import and not used with access token)
 
 Recommended usage pattern:
 
@@ -16,73 +20,248 @@ Recommended usage pattern:
 
 '''
 
+import http.client
 import json
 import logging
+import queue
 import re
+import threading
+import time
 from getpass import getpass
+from io import BytesIO
 from urllib.error import HTTPError
-from urllib.parse import urljoin
-from urllib.request import Request, urlopen
-
-import keyring
+from urllib.parse import urljoin, urlsplit
+from urllib.request import Request
+from urllib.request import __version__ as urllib_version
+from urllib.request import getproxies, proxy_bypass, urlopen
+from urllib.response import addinfourl
 
 try:
-    from .common import pretty_dump
+    from .common import LazyDump, pretty_dump
+    from .rate_limit import call_rate_limited, get_rate_limiter
+    from .timings import record
 except ImportError:
     # preserve ability to launch __main__.py directly
-    from common import pretty_dump
+    from common import LazyDump, pretty_dump
+    from rate_limit import call_rate_limited, get_rate_limiter
+    from timings import record
+
+
+POOL_SIZE = 16
+TIMEOUT = 120
+
+
+class ConnectionPool:
+    '''Idle keep-alive connections to one host'''
+
+    def __init__(self, scheme, netloc, maxsize=POOL_SIZE, timeout=TIMEOUT):
+        self.connection_class = (
+            http.client.HTTPSConnection
+            if scheme == 'https'
+            else http.client.HTTPConnection
+        )
+        self.netloc = netloc
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxsize)
+
+    def request(self, method, path, body, headers):
+        '''Returns response and its fully read body'''
+        while True:
+            try:
+                connection, reused = self.idle.get_nowait(), True
+            except queue.Empty:
+                connection, reused = (
+                    self.connection_class(self.netloc, timeout=self.timeout),
+                    False,
+                )
+            # once the response has started, the server has handled the request
+            # and sending it again may e.g. create duplicate issues
+            retriable = True
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                retriable = False
+                try:
+                    response = connection.getresponse()
+                except http.client.RemoteDisconnected:
+                    # closed without any response
+                    retriable = True
+                    raise
+                data = response.read()
+            except (ConnectionResetError, BrokenPipeError):
+                # RemoteDisconnected is ConnectionResetError too
+                connection.close()
+                if reused and retriable:
+                    # server has closed idle connection, try another one
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                try:
+                    self.idle.put_nowait(connection)
+                except queue.Full:
+                    connection.close()
+            return response, data
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(scheme, netloc):
+    with _pools_lock:
+        if (scheme, netloc) not in _pools:
+            _pools[(scheme, netloc)] = ConnectionPool(scheme, netloc)
+        return _pools[(scheme, netloc)]
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+def open_url(url, method, body, headers):
+    '''Like urlopen(Request(...)) but over a pooled connection'''
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or (
+        parts.scheme in getproxies() and not proxy_bypass(parts.hostname)
+    ):
+        return urlopen(
+            Request(url, data=body, headers=headers, method=method), timeout=TIMEOUT
+        )
+    path = parts.path or '/'
+    if parts.query:
+        path += f'?{parts.query}'
+    headers = {'User-Agent': f'Python-urllib/{urllib_version}', **headers}
+    response, data = get_pool(parts.scheme, parts.netloc).request(
+        method, path, body, headers
+    )
+    if 300 <= response.status < 400 and method in ('GET', 'HEAD'):
+        # redirects are rare here, let urllib follow them
+        return urlopen(
+            Request(url, data=body, headers=headers, method=method), timeout=TIMEOUT
+        )
+    if response.status >= 300:
+        raise HTTPError(
+            url, response.status, response.reason, response.msg, BytesIO(data)
+        )
+    return addinfourl(BytesIO(data), response.msg, url, response.status)
+
+
+# passwords and cookies which have been already read from keyring during this run
+_credentials = {}
+_credentials_lock = threading.RLock()
 
 
 def get_password(service_name, user, overwrite=False):
-    password = keyring.get_password(service_name, user)
-    if password is None or overwrite:
-        password = getpass(prompt='Password for {}: '.format(service_name))
-        keyring.set_password(service_name, user, password)
-        logging.info('saved for future runs')
-    return password
+    with _credentials_lock:
+        password = _credentials.get((service_name, user))
+        if password is not None and not overwrite:
+            return password
+        import keyring
+
+        password = keyring.get_password(service_name, user)
+        if password is None or overwrite:
+            password = getpass(prompt='Password for {}: '.format(service_name))
+            keyring.set_password(service_name, user, password)
+            logging.info('saved for future runs')
+        _credentials[(service_name, user)] = password
+        return password
 
 
-def get_cookie(password_service, user, jira_base, overwrite=False):
+def get_cookie(password_service, user, jira_base, overwrite=False, stale=None):
+    '''
+    overwrite: cookies are not valid anymore, stale: these invalid cookies
+    (if they have already been replaced by another thread, new ones are returned)
+    '''
     cookies_service = '{}_{}_cookies'.format(
         'workflow-templater', re.sub(r'[^a-z0-9]+', '_', jira_base).strip('_')
     )
-    cookies = keyring.get_password(cookies_service, user)
-    if cookies is None or cookies.strip() == '' or overwrite:
-        wrong_password = False
-        for _ in range(3):
-            try:
-                cookie_parts = []
-                data, res_obj = urlopen_jira(
-                    'rest/auth/1/session',
-                    jira_base=jira_base,
-                    method='POST',
-                    data={
-                        'username': user,
-                        'password': get_password(
-                            password_service, user, overwrite=wrong_password
-                        ),
-                    },
-                )
-                logging.debug(data)
-                for k, v in res_obj.headers.items():
-                    if isinstance(k, str) and k.lower() == 'set-cookie':
-                        cookie_parts.append(v.split(';')[0])
-                if len(cookie_parts) == 0:
-                    logging.warning(
-                        f"Haven't received cookies in the response, seen headers: {list(res_obj.headers.keys())}"
+    with _credentials_lock:
+        cookies = _credentials.get((cookies_service, user))
+        if cookies is not None and (
+            not overwrite or (stale is not None and cookies != stale)
+        ):
+            return cookies
+        import keyring
+
+        cookies = keyring.get_password(cookies_service, user)
+        if cookies is None or cookies.strip() == '' or overwrite:
+            wrong_password = False
+            for _ in range(3):
+                try:
+                    cookie_parts = []
+                    data, res_obj = urlopen_jira(
+                        'rest/auth/1/session',
+                        jira_base=jira_base,
+                        method='POST',
+                        data={
+                            'username': user,
+                            'password': get_password(
+                                password_service, user, overwrite=wrong_password
+                            ),
+                        },
                     )
-                    continue
-                cookies = '; '.join(cookie_parts)
-                keyring.set_password(cookies_service, user, cookies)
-                break
-            except HTTPError as e:
-                if e.code == 401:
-                    wrong_password = True
-                    logging.warning('Wrong password')
-                    continue
-    if cookies is None or cookies.strip() == '':
-        raise Exception('Unable to get session from jira')
-    return cookies
+                    logging.debug(data)
+                    for k, v in res_obj.headers.items():
+                        if isinstance(k, str) and k.lower() == 'set-cookie':
+                            cookie_parts.append(v.split(';')[0])
+                    if len(cookie_parts) == 0:
+                        logging.warning(
+                            f"Haven't received cookies in the response, seen headers: {list(res_obj.headers.keys())}"
+                        )
+                        continue
+                    cookies = '; '.join(cookie_parts)
+                    keyring.set_password(cookies_service, user, cookies)
+                    break
+                except HTTPError as e:
+                    if e.code == 401:
+                        wrong_password = True
+                        logging.warning('Wrong password')
+                        continue
+        if cookies is None or cookies.strip() == '':
+            raise Exception('Unable to get session from jira')
+        _credentials[(cookies_service, user)] = cookies
+        return cookies
+
+
+def timed_request(jira_base, url, final_url, method, body, headers):
+    '''open_url with rate limiting, recorded for --timings'''
+    start = time.perf_counter()
+    status = None
+    retries = 0
+    try:
+        response = call_rate_limited(
+            get_rate_limiter(jira_base), open_url, final_url, method, body, headers
+        )
+        status = response.code
+        retries = response.retries
+        return response
+    except HTTPError as e:
+        status = e.code
+        retries = getattr(e, 'retries', 0)
+        raise
+    finally:
+        record(
+            'http',
+            method=method,
+            url=url,
+            status=status,
+            retries=retries,
+            wall=time.perf_counter() - start,
+        )
 
 
 def urlopen_jira(
@@ -109,6 +288,7 @@ def urlopen_jira(
     logging.debug('%s %s %s %s', final_url, user, method, debugdata)
 
     bad_cookies = False
+    cookies = None
     for _ in range(3):
         try:
             headers = {
@@ -120,18 +300,22 @@ def urlopen_jira(
                 else:
                     headers["Authorization"] = f"Bearer {access_token}"
             elif user is not None:
-                headers['Cookie'] = get_cookie(
-                    keyring_service, user, jira_base=jira_base, overwrite=bad_cookies
+                cookies = get_cookie(
+                    keyring_service,
+                    user,
+                    jira_base=jira_base,
+                    overwrite=bad_cookies,
+                    stale=cookies,
                 )
+                headers['Cookie'] = cookies
 
-            res_obj = urlopen(
-                Request(
-                    final_url,
-                    data=json.dumps(data).encode() if data is not None else None,
-                    headers=headers,
-                    method=method,
-                ),
-                timeout=120,
+            res_obj = timed_request(
+                jira_base,
+                url,
+                final_url,
+                method,
+                json.dumps(data).encode() if data is not None else None,
+                headers,
             )
         except HTTPError as e:
             if e.code == 401 and user is not None:
@@ -163,7 +347,7 @@ def urlopen_jira(
             return None, res_obj
         else:
             result = json.load(res_obj)  # json.loads(res_obj.read().decode('utf-8'))
-            logging.debug(pretty_dump(result))
+            logging.debug('%s', LazyDump(result))
             return result, res_obj
 
         raise Exception('This code should have never been reached')
@@ -0,0 +1,56 @@
+'''
+Cache of parsed YAML files. Parsing big vars files with ruamel.yaml is slow,
+so parsed structure is pickled to cache dir and reused while the file
+(path, mtime, size and sha256 of contents) stays the same.
+'''
+
+import hashlib
+import logging
+import os
+import pickle
+import threading
+
+
+def cache_path(cache_dir, path):
+    return os.path.join(
+        cache_dir, hashlib.sha256(path.encode()).hexdigest() + '.pickle'
+    )
+
+
+def load(parse, path, cache_dir=None):
+    '''Parses YAML file with parse(text), cache_dir=None disables cache'''
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        content = f.read()
+    if cache_dir is None:
+        return parse(content.decode('utf8'))
+
+    key = {
+        'path': os.path.realpath(path),
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': hashlib.sha256(content).hexdigest(),
+    }
+    cached = cache_path(cache_dir, key['path'])
+    try:
+        with open(cached, 'rb') as f:
+            cached_key, data = pickle.load(f)
+        if cached_key == key:
+            logging.debug('loaded %s from cache %s', path, cached)
+            return data
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        # broken or written by incompatible version, will be overwritten
+        logging.debug('ignoring yaml cache %s: %s', cached, e)
+
+    data = parse(content.decode('utf8'))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{cached}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((key, data), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cached)
+    except OSError as e:
+        logging.warning('unable to write yaml cache %s: %s', cached, e)
+    return data